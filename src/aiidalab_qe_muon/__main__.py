@@ -52,5 +52,38 @@ def setup_python3():
         print("Code python3@localhost is already installed! Nothing to do here.")
 
 
+@cli.command(help="Export the results of ImplantMuonWorkChains (given as PKS, or in a group) to files.")
+@click.argument("pks", nargs=-1, type=int)
+@click.option("-g", "--group", default=None, help="Label of a group of workchains to export.")
+@click.option(
+    "-o", "--output-dir", default="muon_exports", show_default=True,
+    type=click.Path(file_okay=False), help="One sub-folder per workchain is created here.",
+)
+@click.option("-j", "--jobs", default=1, show_default=True, help="Number of parallel worker processes.")
+@click.option(
+    "-f", "--format", "export_format", default="csv", show_default=True,
+    type=click.Choice(["csv", "hdf5"]), help="Format of the polarization (and distortions) data. hdf5 requires h5py.",
+)
+def export(pks, group, output_dir, jobs, export_format):
+    from aiidalab_qe_muon.utils.export import export_workchains, get_implant_muon_workchains
+    
+    profile = load_profile()
+    workchains = get_implant_muon_workchains(pks, group=group)
+    if not workchains:
+        raise click.UsageError("No ImplantMuonWorkChain found for the given PKS or group.")
+    
+    failed = 0
+    for pk, written, exception in export_workchains(
+        workchains, output_dir, jobs=jobs, profile=profile.name, format=export_format,
+    ):
+        if exception is not None:
+            failed += 1
+            click.echo(f"Workchain {pk}: export failed ({exception})", err=True)
+        else:
+            click.echo(f"Workchain {pk}: {len(written)} files written in {output_dir}/{pk}")
+    if failed:
+        raise SystemExit(1)
+
+
 if __name__ == "__main__":
     cli()
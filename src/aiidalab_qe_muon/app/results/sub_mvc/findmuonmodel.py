@@ -13,6 +13,16 @@ from aiidalab_qe_muon.utils.data import (
     no_Bfield_sentence,
     color_code,
 )
+from aiidalab_qe_muon.utils.findmuon import (
+    build_distortion_array,
+    distortion_dataframes,
+    get_ase_structures,
+    get_structures,
+    prepare_findmuon_files,
+    table_legend,
+    write_archive,
+    write_distortions_hdf5,
+)
 
 from aiida import orm
 import ase
@@ -43,6 +53,8 @@ class FindMuonModel(Model):
     table_data = tl.List(tl.List())
     
     advanced_table = tl.Bool(False)
+    table_page = tl.Int(0)
+    table_page_size = tl.Int(50) # rows per page of the displayed table.
     table_legend_text = tl.Unicode("")
     
     supercell_was_small = tl.Bool(False)
@@ -60,6 +72,9 @@ class FindMuonModel(Model):
     distortions_y = tl.Unicode("delta_distance") # delta_distance (difference of the norms of the distances from the muon, final and init.), distortion (norm of vector difference)
     distortions_x = tl.Unicode("atm_distance_final") # atm_distance_init, atm_distance_final
     
+    max_payload_size = 20 * 1024**2 # bytes; larger archives are served by the jupyter server, see _download_link.
+    export_lifetime = 600 # seconds after which a served archive is deleted.
+    
     @observe("selected_muons")
     def _on_selected_muons(self, _=None):
         self.selected_labels = self.findmuon_data["table"].loc[self.selected_muons, "label"].tolist()
@@ -67,6 +82,11 @@ class FindMuonModel(Model):
     def fetch_data(self):
         """Fetch the findmuon data from the FindMuonWorkChain outputs."""
         self.findmuon_data = export_findmuon_data(self.muon.findmuon)
+        self._structures = {} # {pk: StructureData}, see `get_structures`.
+        self._ase_structures = {} # {pk: ase.Atoms}
+        self._table_rows = {} # {advanced_table: (header, rows)}, see `_generate_table_data`.
+        # the structures of the sites after clustering, shown when selected, are loaded in one go.
+        self.get_structures(self.findmuon_data["table"]["structure_id_pk"])
         self.muon_index_list = self.findmuon_data["table"].index.tolist()
         self.selected_muons = self.muon_index_list[0:1]
         
@@ -75,6 +95,9 @@ class FindMuonModel(Model):
         self.full_muon_labels = self.findmuon_data["table"]["label"].tolist()
         
         self.distortions = self.findmuon_data["distortions"]
+        self.distortion_array, self.distortion_slices, self.distortion_element_slices = self.build_distortion_array(
+            self.distortions
+        )
 
         
         self.sc_matrix = self.muon.findmuon.all_index_uuid.creator.caller.inputs.sc_matrix.get_list()
@@ -95,38 +118,65 @@ class FindMuonModel(Model):
         And then in the view we select only the one we want to inspect.
         """
         if len(self.selected_muons) == 1 and self.selected_view_mode == 0:
-            self.structure = orm.load_node(self.findmuon_data["table"].loc[self.selected_muons[0],"structure_id_pk"])
+            pk = int(self.findmuon_data["table"].loc[self.selected_muons[0],"structure_id_pk"])
+            self.structure = self.get_structures([pk])[pk]
         elif self.selected_view_mode == 1:
             self.structure = self.findmuon_data["unit_cell"]
     
+    def get_structures(self, pks) -> dict:
+        """Return {pk: StructureData} for the given pks, see `aiidalab_qe_muon.utils.findmuon.get_structures`.
+        
+        The structures which were not already loaded by this model are loaded with a single query.
+        """
+        return get_structures(pks, cache=self._structures)
+
+    def get_ase_structures(self, pks) -> dict:
+        """Same as `get_structures`, but returns (cached) ase.Atoms."""
+        return get_ase_structures(pks, cache=self._structures, ase_cache=self._ase_structures)
+
     def convert_label_to_html(self, entry) -> str:
         # to have nice names in the html, instead of the column names.
         return dictionary_of_names_for_html[entry]
     
     
     
-    def _generate_table_data(self,) -> str:
+    def _generate_table_data(self) -> str:
         """Generate a table from the selected data.
         
         This method is called by the controller to get the html table.
+        The rows of each variant (basic or advanced) are built once, in one pass, and cached;
+        only the rows of the current page are put in `table_data`.
         """
-        excluded_columns = ["tot_energy","muon_index_global_unitcell","muon_index"]
-        if self.advanced_table:
-            excluded_columns = ["muon_index"]
+        if self.advanced_table not in self._table_rows:
+            excluded_columns = ["tot_energy","muon_index_global_unitcell","muon_index"]
+            if self.advanced_table:
+                excluded_columns = ["muon_index"]
             
-        data = [[self.convert_label_to_html(entry) for entry in self.findmuon_data["table"].columns.to_list() if entry not in excluded_columns]]
-        #data[-1].pop(-3)
-        for index in self.findmuon_data["table"].index:
-            data.append(self.findmuon_data["table"].drop(excluded_columns, axis=1).loc[index].to_list())
-            #data[-1].pop(-3)
-        self.table_data = data
+            table = self.findmuon_data["table"].drop(columns=excluded_columns)
+            header = [self.convert_label_to_html(entry) for entry in table.columns.to_list()]
+            self._table_rows[self.advanced_table] = (header, table.to_numpy().tolist())
+        
+        header, rows = self._table_rows[self.advanced_table]
+        start = self.table_page * self.table_page_size
+        self.table_data = [header] + rows[start:start + self.table_page_size]
+    
+    @property
+    def table_pages(self):
+        """Number of pages of the displayed table."""
+        return max(-(-len(self.findmuon_data["table"]) // self.table_page_size), 1)
         
     def get_distorsion_data(self):
         """Get the distorsion data for the selected site.
         
         This method is called by the controller to get the data for the distorsion plot.
+        Returns {element: view of `distortion_array`}, each column being accessed as data[column].
         """        
-        return self.distortions[str(self.selected_muons[-1])]
+        return {
+            element: self.distortion_array[element_slice]
+            for element, element_slice in self.distortion_element_slices[str(self.selected_muons[-1])].items()
+        }
+    
+    build_distortion_array = staticmethod(build_distortion_array)
     
     @staticmethod
     def _prepare_single_structure_for_download(structure) -> str:
@@ -137,123 +187,36 @@ class FindMuonModel(Model):
         with open(tmp.name, "rb") as raw:
             return base64.b64encode(raw.read()).decode()
     
-    def _prepare_structures_for_download(self) -> str:
-        """Prepare the structures for download.
-        
-        This method is called by the controller to get the data for download.
-        """
-        # prepare (all) the structures for download as ase atoms objects
-        structures = {}
-        for index, label in zip(self.findmuon_data["table_all"]["muon_index"],self.findmuon_data["table_all"]["label"]):
-            node_id = self.findmuon_data["table_all"].loc[self.findmuon_data["table_all"]["muon_index"] == index, "structure_id_pk"].values[0]
-            structure = orm.load_node(node_id).get_ase()
-            structures[label] = structure
-        
-        structures["unit_cell"] = self.findmuon_data["unit_cell"].get_ase()
-        structures["unit_cell_all"] = self.findmuon_data["unit_cell_all"].get_ase()
-        structures["supercell_all"] = self.findmuon_data["supercell_all"].get_ase()
-        
-        return structures
-    
     def _prepare_distortions_for_download(self) -> str:
         """Prepare the distortions for download.
         
         This method is called by the controller to get the data for download.
         """
-        # prepare the distortions for download as json
-        import pandas as pd
-        
-        distortions_df = {}
-        for index, label in zip(self.findmuon_data["table_all"]["muon_index"],self.findmuon_data["table_all"]["label"]):
-            distortion = {}
-            distortion["atm_distance_init"] = []
-            distortion["atm_distance_final"] = []
-            distortion["distortion"] = []
-            distortion["delta_distances"] = []
-            distortion["element"] = []
-            
-            for element,data in self.distortions[index].items():
-                for i in range(len(data["atm_distance_init"])):
-                    distortion["atm_distance_init"].append(data["atm_distance_init"][i])
-                    distortion["atm_distance_final"].append(data["atm_distance_final"][i])
-                    distortion["delta_distances"].append(data["delta_distance"][i])
-                    distortion["distortion"].append(data["distortion"][i])
-                    distortion["element"].append(element)
-                    
-            df = pd.DataFrame.from_dict(distortion).sort_values(by="atm_distance_init")
-            distortions_df[label] = df
-        
-        return distortions_df
+        return distortion_dataframes(self.findmuon_data["table_all"], self.distortion_array, self.distortion_slices)
     
     def _prepare_data_for_download(self) -> str:
-        """Prepare the data for download.
+        """Prepare the data for download (see `aiidalab_qe_muon.utils.findmuon.prepare_findmuon_files`).
         
         This method is called by the controller to get the data for download.
         """
-        # prepare the data for download as csv file
-        files_dict = {}
-        files_dict["table"] = self.findmuon_data['table']
-        files_dict["table_all"] = self.findmuon_data['table_all']
-        files_dict["structures"] = self._prepare_structures_for_download()
-        formula = orm.load_node(self.findmuon_data["table"].loc[self.muon_index_list[0],"structure_id_pk"]).get_formula()
-        files_dict["filename"] = f"exported_mu_res_{formula}_WorkflowID_{self.muon.findmuon.all_index_uuid.creator.caller.caller.caller.pk}.zip"
-        
-        files_dict["distortions"] = self._prepare_distortions_for_download()
-        
-        self.generate_table_legend(download_mode=True)
-        files_dict["readme"] = self.readme_text
+        files_dict = prepare_findmuon_files(
+            self.muon.findmuon,
+            self.findmuon_data,
+            advanced_table=self.advanced_table,
+            structures=self._structures,
+            ase_structures=self._ase_structures,
+            distortions=self._prepare_distortions_for_download(),
+        )
+        self.readme_text = files_dict["readme"]
         return files_dict
     
-    @staticmethod
-    def produce_bitestream(files_dict):
-        import tempfile
-        import pathlib
-        import shutil
-        import os
-        
-        with tempfile.TemporaryDirectory() as dirpath:
-            path = pathlib.Path(dirpath) / "downloadable_data"
-            output_zip_path = pathlib.Path(dirpath) / "downloadable_data.zip"
-            
-            os.mkdir(path)
-            
-            # Tables
-            files_dict["table"].drop(columns="muon_index").to_csv(path / "Summary_table.csv", index=True)
-            files_dict["table_all"].drop(columns="muon_index").to_csv(path / "Summary_table_before_clustering.csv", index=True)
-            
-            # Structures
-            for label, structure in files_dict["structures"].items():
-                if label == "unit_cell":
-                    structure.write(path / f"Allsites_unitcell.cif", format="cif")
-                elif label == "unit_cell_all":
-                    structure.write(path / f"Allsites_before_clustering_unitcell.cif", format="cif")
-                elif label == "supercell_all":
-                    structure.write(path / f"Allsites_before_clustering_supercell.cif", format="cif")
-                else:
-                    structure.write(path / f"Supercell_{label}.cif", format="cif")
-            
-            # Distortions
-            for label, df in files_dict["distortions"].items():
-                df.to_csv(path / f"Distortion_supercell_{label}.csv", index=False)
-            
-            # README
-            with open(path / "README.txt", "w") as f:
-                f.write(files_dict["readme"])
-            
-            shutil.make_archive(path, "zip", path)
-                    
-            with open(output_zip_path, "rb") as f:
-                    raw_data = f.read()
-
-            # Convert the raw_data to base64 so it can be used as a payload in JavaScript
-            bitestream = base64.b64encode(raw_data).decode()
-
-        return bitestream
+    write_archive = staticmethod(write_archive)
+    write_distortions_hdf5 = staticmethod(write_distortions_hdf5)
     
     @staticmethod
     def _download(payload, filename):
         """Download payload as a file named as filename."""
-        from IPython.display import Javascript
+        from IPython.display import Javascript, display
 
         javas = Javascript(
             f"""
@@ -352,25 +315,94 @@ class FindMuonModel(Model):
         )
 
     def download_data(self, _=None):
-        """Function to download the data."""
+        """Function to download the data.
+        
+        Small archives are downloaded directly (as a base64 payload); larger ones are served by the
+        jupyter server running the app (see `_download_link`), not to freeze the browser.
+        """
+        import tempfile
+        
         files_dict = self._prepare_data_for_download()
-        payload = self.produce_bitestream(files_dict)
-        self._download(payload=payload, filename=files_dict["filename"])
+        # kept in memory up to max_payload_size, then rolled over to a temporary file.
+        with tempfile.SpooledTemporaryFile(max_size=self.max_payload_size) as archive:
+            self.write_archive(files_dict, archive)
+            size = archive.tell()
+            archive.seek(0)
+            server = self._get_jupyter_server() if size > self.max_payload_size else None
+            if server is None:
+                self._download(payload=base64.b64encode(archive.read()).decode(), filename=files_dict["filename"])
+                return
+            self._download_link(archive, filename=files_dict["filename"], server=server)
+    
+    @staticmethod
+    def _get_jupyter_server():
+        """The (root_dir, base_url) of the jupyter server running the app, None if not found.
+        
+        This is the running server whose root contains the current working directory (the app folder).
+        """
+        import pathlib
+        
+        try:
+            from jupyter_server.serverapp import list_running_servers
+        except ImportError:
+            return None
+        
+        cwd = pathlib.Path.cwd().resolve()
+        for server in list_running_servers():
+            root = pathlib.Path(server.get("root_dir", "")).expanduser().resolve()
+            if root == cwd or root in cwd.parents:
+                return root, server.get("base_url", "/")
+        return None
+    
+    def _download_link(self, archive, filename, server):
+        """Download the archive from a temporary folder in the root of the jupyter `server`.
+        
+        The folder is deleted after `export_lifetime` seconds (the download has started immediately),
+        when the kernel exits, or at the next export if the kernel did not exit cleanly.
+        """
+        import atexit
+        import functools
+        import pathlib
+        import shutil
+        import tempfile
+        import threading
+        import time
+        import urllib.parse
+        from IPython.display import Javascript, display
+        
+        root, base_url = server
+        for stale in root.glob("muon_export_*"):
+            if time.time() - stale.stat().st_mtime > self.export_lifetime:
+                shutil.rmtree(stale, ignore_errors=True)
+        
+        folder = pathlib.Path(tempfile.mkdtemp(prefix="muon_export_", dir=root))
+        path = folder / filename
+        with open(path, "wb") as handle:
+            shutil.copyfileobj(archive, handle)
+        
+        cleanup = functools.partial(shutil.rmtree, folder, ignore_errors=True)
+        atexit.register(cleanup)
+        timer = threading.Timer(self.export_lifetime, cleanup)
+        timer.daemon = True
+        timer.start()
+        
+        url = f"{base_url.rstrip('/')}/files/{urllib.parse.quote(path.relative_to(root).as_posix())}?download=1"
+        display(Javascript(
+            f"""
+            var link = document.createElement('a');
+            link.href = '{url}'
+            link.download = "{filename}"
+            document.body.appendChild(link);
+            link.click();
+            document.body.removeChild(link);
+            """
+        ))
+        return path
         
     def generate_table_legend(self, download_mode=False):
         """Generate the table legend."""
-        from importlib_resources import files
-        from jinja2 import Environment
-        from aiidalab_qe_muon.app.static import templates
-        
-        env = Environment()
-        table_legend_template = files(templates).joinpath("table_legend.html.j2").read_text()
-        table_legend_text = env.from_string(table_legend_template).render(
-            {"B_fields": not self.no_B_in_DFT, 
-             "advanced_table":self.advanced_table,
-             "data":dictionary_of_names_for_html,
-             "download_mode":download_mode,
-            }
+        table_legend_text = table_legend(
+            B_fields=not self.no_B_in_DFT, advanced_table=self.advanced_table, download_mode=download_mode,
         )
         
         if download_mode:
@@ -17,6 +17,7 @@ from aiidalab_qe_muon.utils.data import (
     color_code,
     unit_cell_explanation_text,
     distortions_plot_explanation_text,
+    webgl_points_threshold,
 )
 
 
@@ -71,8 +72,27 @@ class FindMuonWidget(ipw.VBox):
         )
         self._update_table()
         self.table.selected_rows = [0]
+        # the selection in rows of the whole table (not of the page), see `_on_selected_rows_change`.
+        self._selected_rows = [0]
+        self._showing_selection = False
         self.table.observe(self._on_selected_rows_change,"selected_rows")
         
+        # only shown if the table has more than one page.
+        self.table_page = ipw.BoundedIntText(
+            value=1,
+            min=1,
+            max=self._model.table_pages,
+            description=f"Page (of {self._model.table_pages}):",
+            style={'description_width': 'initial'},
+            layout=ipw.Layout(width="auto", display="none" if self._model.table_pages == 1 else "flex"),
+        )
+        ipw.dlink(
+            (self.table_page, "value"),
+            (self._model, "table_page"),
+            lambda page: page - 1,
+        )
+        self.table_page.observe(self._on_table_page_change, names="value")
+        
         self.advanced_table = ipw.Checkbox(
             description="Advanced table mode",
             button_style="primary",
@@ -229,7 +249,7 @@ class FindMuonWidget(ipw.VBox):
             InAppGuide(identifier="muon-stopping-sites-results"),
             self.title,
             self.table,
-            ipw.HBox([self.advanced_table, self.about_toggle, download_button,],),
+            ipw.HBox([self.advanced_table, self.about_toggle, download_button, self.table_page,],),
             self.table_legend_infobox,
             self.structure_view_container,
             ipw.HBox([
@@ -250,6 +270,22 @@ class FindMuonWidget(ipw.VBox):
     def on_advanced_table_change(self, change):
         self._model.generate_table_legend()
         self._model._generate_table_data()
+        self._show_selected_rows()
+        
+    def _on_table_page_change(self, change):
+        self._model._generate_table_data()
+        # the selected sites do not change: they are only highlighted if they are in the new page.
+        self._show_selected_rows()
+    
+    def _show_selected_rows(self):
+        """Highlight the selected rows of the current page, without changing the selection."""
+        offset = self._model.table_page * self._model.table_page_size
+        n_rows = len(self._model.table_data) - 1
+        self._showing_selection = True
+        # the redrawn table has no highlighted rows: reset them, even if the indexes are the same.
+        self.table.selected_rows = []
+        self.table.selected_rows = [row - offset for row in self._selected_rows if 0 <= row - offset < n_rows]
+        self._showing_selection = False
         
     def display_table_legend(self, change):
         self.table_legend_infobox.layout.display = "block" if change["new"] else "none"
@@ -268,20 +304,33 @@ class FindMuonWidget(ipw.VBox):
         #self._update_table()
         
     def _on_selected_rows_change(self, change):
+        if self._showing_selection:
+            return
         
+        # the selected rows of the other pages are kept, so that sites in different pages can be compared.
+        offset = self._model.table_page * self._model.table_page_size
+        page_rows = range(offset, offset + len(self._model.table_data) - 1)
+        selected_rows = [row for row in self._selected_rows if row not in page_rows] + [
+            offset + index for index in self.table.selected_rows
+        ]
         if not self.compare_muons_button.value:
-            self.table.selected_rows = self.table.selected_rows[-1:]
-            if len(self.table.selected_rows) == 0:
-                self.table.selected_rows = [0]
-            
+            selected_rows = selected_rows[-1:] or [offset]
+        self._selected_rows = selected_rows
+        
+        page_selection = [row - offset for row in selected_rows if row in page_rows]
+        if self.table.selected_rows != page_selection:
+            self._showing_selection = True
+            self.table.selected_rows = page_selection
+            self._showing_selection = False
+        
         self._model.selected_muons = [
-            int(self._model.findmuon_data["table"].iloc[index].muon_index) # because are stored as strings!
-            for index in self.table.selected_rows
+            int(self._model.findmuon_data["table"].iloc[row].muon_index) # because are stored as strings!
+            for row in selected_rows
             ]
         
         self._model.selected_labels = [
-            self._model.findmuon_data["table"].iloc[index].label
-            for index in self.table.selected_rows
+            self._model.findmuon_data["table"].iloc[row].label
+            for row in selected_rows
             ]
         
         self._on_selected_muons_change()
@@ -318,25 +367,22 @@ class FindMuonWidget(ipw.VBox):
     def _update_distortions_plot(self, _=None):
         
         data_to_plot = self._model.get_distorsion_data()
-        if not self.rendered:
-            self._model.populate_distortion_figure(
-                distortion_data=data_to_plot,
-                distortions_figure=self.distortions_plot,
-                callback=go.Scatter,
-                muon_label=self._model.selected_labels[0],
-                x_quantity=self._model.distortions_x,
-                y_quantity=self._model.distortions_y,
-            )
-        else:
-            self._model.populate_distortion_figure(
-                distortion_data=data_to_plot,
-                distortions_figure=self.distortions_plot,
-                callback=go.Scatter,
-                muon_label=self._model.selected_labels[0],
-                x_quantity=self._model.distortions_x,
-                y_quantity=self._model.distortions_y,
-                just_update=True,
-            )
+        # every atom is a marker: WebGL for large supercells.
+        n_points = sum(len(data[self._model.distortions_x]) for data in data_to_plot.values())
+        scatter = go.Scattergl if n_points > webgl_points_threshold else go.Scatter
+        just_update = self.rendered and all(isinstance(trace, scatter) for trace in self.distortions_plot.data)
+        if self.rendered and not just_update:
+            self.distortions_plot.data = ()
+            self.distortions_plot.layout.shapes = ()
+        self._model.populate_distortion_figure(
+            distortion_data=data_to_plot,
+            distortions_figure=self.distortions_plot,
+            callback=scatter,
+            muon_label=self._model.selected_labels[0],
+            x_quantity=self._model.distortions_x,
+            y_quantity=self._model.distortions_y,
+            just_update=just_update,
+        )
            
     def _update_table(self, _=None):
         self._model._generate_table_data()
@@ -7,6 +7,20 @@ import json
 
 from aiida import orm
 
+from aiidalab_qe_muon.undi_interface.polarization import (
+    LazySites,
+    get_polarization_data,
+    get_polarization_workflow,
+    get_sites,
+    isotopic_averages,
+    load_site,
+    polarization_plot_data,
+    unpack_polarization_arrays,
+    unpack_undi_nodes,
+    unpack_undi_outputs,
+)
+from aiidalab_qe_muon.utils.downsample import minmax_downsample
+
 
 class PolarizationModel(Model):
     """PolarizationModel is a class designed for handling polarization plots and convergence analysis.
@@ -31,6 +45,8 @@ class PolarizationModel(Model):
     fields = [0.0] # initial guess for the computed fields, then we will load the fields from the nodes.
     selected_isotopes = [] # we will load the isotopes from the nodes. We don't allows choose among them, so no trait.
     estimated_convergence = 0
+    max_loaded_sites = 8 # sites whose results are kept in memory (at least the selected ones), see `LazySites`.
+    max_points_per_trace = 800 # about the width of the plot in pixels, see `downsample`.
     
     muon = tl.Union(
         [
@@ -90,6 +106,7 @@ class PolarizationModel(Model):
     )
     
     selected_labels = tl.List(trait=tl.Unicode(), default_value=["A"])
+    analysed_index = tl.Unicode(None, allow_none=True) # the site shown in the "analysis" mode, one at a time.
     
     def __init__(self, node=None, undi_nodes=None, KT_node=None, mode="plot", single_muon=False):
         
@@ -109,39 +126,59 @@ class PolarizationModel(Model):
             self.selected_labels = ["A"]
             
             
+    @tl.observe("selected_labels")
+    def _on_selected_labels_change(self, _=None):
+        # load the newly selected sites, if the nodes were already fetched; all of them are kept loaded.
+        if self.mode == "plot" and isinstance(getattr(self, "muons", None), LazySites):
+            self.muons.maxsize = max(self.max_loaded_sites, len(self.selected_labels))
+            for label in self.selected_labels:
+                if label in self.full_muon_labels:
+                    self.muons.get(str(self.full_muon_indexes[self.full_muon_labels.index(label)]))
+
+    @tl.observe("analysed_index")
+    def _on_analysed_index_change(self, _=None):
+        if self.mode == "analysis" and self.analysed_index is not None:
+            self.selected_labels = [self.get_label(self.analysed_index)]
+
     @property
     def selected_indexes(self):
-        # doing it explicitely dummy, we need to change this
         if self.mode == "analysis":
-            return [s for s in self.muons.keys()]
+            # only one site at a time: each site has its own convergence ladder.
+            return [int(self.analysed_index)]
         selected_indexes = []
         for label in self.selected_labels:
             selected_indexes.append(
                 self.full_muon_indexes[self.full_muon_labels.index(label)]
                 )
-        if len(selected_indexes) != len(self.selected_labels):
-            raise ValueError(selected_indexes, self.selected_labels)
         return selected_indexes
     
+    def get_label(self, muon_index):
+        """The label of the site `muon_index` in the findmuon table, or the index itself if not there."""
+        if int(muon_index) in self.full_muon_indexes:
+            return self.full_muon_labels[self.full_muon_indexes.index(int(muon_index))]
+        return str(muon_index)
+    
 
     def get_data_plot(
         self,
     ):
         """Prepare the data to just be plugged in in the FigureWidget."""
 
-        for muon_index in self.muons.keys():
-            
-            self.muons[muon_index].data = {
-                "y": {
-                    "lf": self.compute_isotopic_averages(field_direction="lf", muon_index=muon_index),
-                    "tf": self.compute_isotopic_averages(field_direction="tf", muon_index=muon_index)
-                    if self.mode == "plot"
-                    else None,  # one element each node. These elements are dictionaries containing x,y,z signals averaged wrt the isotopes.
-                }
-            }
+        # only the sites which were already loaded: the others get their data when they are first accessed.
+        for muon in self.muons.loaded_values():
+            self._set_data_plot(muon)
 
-            self.muons[muon_index].data["x"] = np.array(self.muons[muon_index].results[0][0]["t"]) * 1e6
+    def _set_data_plot(self, muon):
+        muon.data = polarization_plot_data(muon, mode=self.mode)
             
+    def downsample(self, x, y, x_range=None):
+        """Return the (x, y) points of a curve to be displayed within `x_range`, at most `max_points_per_trace`.
+
+        Only for the plots: the downloads always use the full resolution data.
+        """
+        indexes = minmax_downsample(x, y, self.max_points_per_trace, x_range)
+        return np.asarray(x)[indexes], np.asarray(y)[indexes]
+
     def create_cluster_matrix(
         self,
     ):
@@ -167,81 +204,33 @@ class PolarizationModel(Model):
         we distinguish if nodes are shelljobs (done as in examples_aiida/shelljob.py) or not,
         i.e. in case we submitted pythonjobs via the aiida-workgraph plugin.
         """
+        data = None
         if not hasattr(self, "nodes"):
             try:
                 self.nodes = self.muon.polarization.base.links.get_incoming().get_node_by_label('execution_count').called
             except Exception as e:
-                self.nodes = self.muon.polarization.creator.caller.caller.called
+                data = get_polarization_data(get_polarization_workflow(self.muon.polarization).pk)
+                self.nodes = data.nodes
                 
         # workgraph case - always the case in standard situations (qe app usage)
-        if "workgraph" in self.nodes[0].process_type:
-            # this loops can be improved, for sure there is a smarter way to do this.
+        if "workgraph" in self.nodes[0].process_type or "pythonjob" in self.nodes[0].process_type:
             
-            self.muons = {} # each muon will be a key of this dictionary.
-            
-            for muon in self.nodes: # this need to be the called of the MultiSites task.
-                
-                #muon_index = muon.base.extras.get("muon_index", 0)
-                muon_index = muon.base.attributes.all.get("metadata_inputs",{}).get("metadata",{}).get("call_link_label","0").replace("polarization_structure_","")
-                
-                if self.mode == "analysis":
-                    if not "convergence_check" in muon.base.links.get_outgoing().all_link_labels():
-                        continue
-                    
-                self.muons[muon_index] = AttributeDict()
-                
-                main_node = muon
-
-                search = "undi_runs"
-                if self.mode == "analysis":
-                    search = "convergence_check"
-
-                descendants = (
-                    main_node.base.links.get_outgoing().get_node_by_label(search).called
-                )
-
-                results = [
-                    node.outputs.result.get_list() for node in descendants
-                ]
-                
-                fields = [
-                    node.inputs.function_inputs.B_mod.value * 1000 for node in descendants
-                ]  # mT
-                selected_fields = [
-                    node.inputs.function_inputs.B_mod.value * 1000 for node in descendants
-                ]  # mT
-                max_hdims = [
-                    int(node.inputs.function_inputs.max_hdim.value) for node in descendants
-                ]
-                
-                self.isotopes = [
-                    [res["cluster_isotopes"], res["spins"], res["probability"]]
-                    for res in results[0]
-                ]
-
-                self.selected_isotopes = list(range(len(self.isotopes)))
-
-                if self.mode == "plot":
-                    self.muons[muon_index].KT_output = (
-                        main_node.base.links.get_outgoing()
-                        .get_node_by_label("KuboToyabe_run")
-                        .outputs.result.get_dict()
-                    )
-                
-                # re-ordering all the results according to the fields or the max_hdim.
-                if self.mode == "plot":
-                    sorted_order = np.argsort(fields)
-                    self.fields = [fields[i] for i in sorted_order]
-                    self.selected_fields = [selected_fields[i] for i in sorted_order]
-                    self.max_hdims = max_hdims
-                else:
-                    sorted_order = np.argsort(max_hdims)
-                    self.max_hdims = [max_hdims[i] for i in sorted_order]
-                    self.fields = fields
-                    self.selected_fields = selected_fields
-                
-                self.muons[muon_index].results = [results[i] for i in sorted_order]
-                self.muons[muon_index].fields = self.fields
+            self._data = data or get_polarization_data(self.nodes[0].caller.pk)
+            # each muon will be a key of this mapping, loaded only when accessed (i.e. when selected);
+            # symmetry equivalent sites were not computed: they share the results of their representative.
+            self.muons = get_sites(self._data, mode=self.mode, load=self._load_site, maxsize=self.max_loaded_sites)
+            indexes = self.muons.indexes
+            # the fields, isotopes and max_hdims of the model are the ones of the first site, and are set
+            # only here: loading the other sites (when selected) does not change them.
+            first_muon = self.muons[indexes[0]]
+            self.fields = list(first_muon.fields)
+            self.selected_fields = list(first_muon.fields)
+            self.max_hdims = list(first_muon.max_hdims)
+            self.isotopes = first_muon.isotopes
+            self.selected_isotopes = list(range(len(self.isotopes)))
+            if self.mode == "analysis":
+                self.production_max_hdim = first_muon.production_max_hdim
+                self.analysed_index = indexes[0]
         else:
             # shelljob case - Will never be the case in the app.
             self.fields = [
@@ -262,6 +251,15 @@ class PolarizationModel(Model):
             self.selected_isotopes = list(range(len(self.isotopes)))
 
 
+    def _load_site(self, muon_index):
+        """Load the results of a single site (see `fetch_data`), including the data to be plotted."""
+        return load_site(self._data, muon_index, mode=self.mode)
+
+    # the (static) readers of the undi nodes, see `aiidalab_qe_muon.undi_interface.polarization`.
+    unpack_undi_nodes = staticmethod(unpack_undi_nodes)
+    unpack_undi_outputs = staticmethod(unpack_undi_outputs)
+    unpack_polarization_arrays = staticmethod(unpack_polarization_arrays)
+
     def create_html_table(self, first_row=[]):
         """
         Create an HTML table representation of a Nx3 matrix. N is the number of isotope mixtures.
@@ -338,27 +336,8 @@ class PolarizationModel(Model):
         )
         display(javas)
     
-    def compute_isotopic_averages(self, field_direction="lf", muon_index = "0"):
-        selected_isotopes = list(range(len(self.isotopes)))
-        weights = [self.isotopes[int(i)][-1] for i in selected_isotopes if i != ""]
-        averages_full = []
-        for index in range(len(self.muons[muon_index].results)):
-            averages = {}
-            for direction in ["z", "x", "y", "powder"]:
-                if self.mode == "analysis" and direction in ["x", "y", "powder"]:
-                    continue
-
-                values = [
-                    self.muons[muon_index].results[index][int(i)][f"signal_{direction}_{field_direction}"]
-                    for i in selected_isotopes
-                    if i != ""
-                ]
-
-                # Compute the weighted average
-                averages[f"signal_{direction}"] = np.average(
-                    values, weights=weights, axis=0
-                )
-
-            averages_full.append(averages)
-
-        return averages_full
+    def compute_isotopic_averages(self, field_direction="lf", muon_index = "0", muon=None):
+        if muon is None:
+            muon = self.muons[muon_index]
+        directions = ["z", "x", "y", "powder"] if self.mode == "plot" else ["z"]
+        return isotopic_averages(muon, field_direction=field_direction, directions=directions)
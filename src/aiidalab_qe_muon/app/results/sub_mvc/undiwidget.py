@@ -13,6 +13,7 @@ from aiidalab_qe.common.widgets import LoadingWidget
 from aiidalab_qe.common.infobox import InAppGuide
 
 from aiidalab_qe_muon.app.results.sub_mvc.undimodel import PolarizationModel
+from aiidalab_qe_muon.utils.data import webgl_points_threshold
 
 class UndiPlotWidget(ipw.VBox):
     """_summary_
@@ -145,18 +146,7 @@ class UndiPlotWidget(ipw.VBox):
             
         else:
             
-            used_hdim = int(np.log10(self._model.max_hdims[-2]))
-            description = ipw.HTML(
-                f"""
-                This section allows you to examine the convergence with respect to the maximum Hilbert space dimension (max<sub>hdim</sub>),
-                which is used to construct the Hamiltonian for muon-nuclei interactions. For more details, please refer to the 
-                <a href="https://undi.readthedocs.io/en/latest/examples/auto.html#approximations" target="_blank">documentation</a>. <br>
-                <ul>
-                    <li> A reference polarization P<sub>r</sub>(t) is computed using a max<sub>hdim</sub> larger than the
-                    value used in the 'Polarization data' plot (max<sub>hdim</sub>=10<sup>{used_hdim}</sup>); </li>
-                </ul>
-                """
-            )
+            self.convergence_description = ipw.HTML(self._get_convergence_description())
             
             self.plotting_quantity = ipw.ToggleButtons(
                 options=[
@@ -172,13 +162,42 @@ class UndiPlotWidget(ipw.VBox):
             )
             self.plotting_quantity.observe(self._on_plotting_quantity_change, "value")
 
-            self.children = [
-                description,
+            self.children = [self.convergence_description]
+            
+            if len(self._model.muons.indexes) > 1:
+                # e.g. with an adaptive max_hdim, each site has its own convergence check.
+                site_selector = ipw.Dropdown(
+                    description="Muon site:",
+                    options=[
+                        (self._model.get_label(muon_index), muon_index) for muon_index in self._model.muons.indexes
+                    ],
+                    value=self._model.analysed_index,
+                )
+                ipw.dlink(
+                    (site_selector, "value"),
+                    (self._model, "analysed_index"),
+                )
+                self._model.observe(self._on_analysed_index_change, "analysed_index")
+                self.children += (site_selector,)
+            
+            self.children += (
                 self.fig,
                 self.plotting_quantity,
-            ]
+            )
 
         self.rendered = True
+    
+    def _get_convergence_description(self):
+        used_hdim = int(np.log10(self._model.muons[self._model.analysed_index].production_max_hdim))
+        return f"""
+                This section allows you to examine the convergence with respect to the maximum Hilbert space dimension (max<sub>hdim</sub>),
+                which is used to construct the Hamiltonian for muon-nuclei interactions. For more details, please refer to the 
+                <a href="https://undi.readthedocs.io/en/latest/examples/auto.html#approximations" target="_blank">documentation</a>. <br>
+                <ul>
+                    <li> A reference polarization P<sub>r</sub>(t) is computed using a max<sub>hdim</sub> larger than the
+                    value used in the 'Polarization data' plot (max<sub>hdim</sub>=10<sup>{used_hdim}</sup>); </li>
+                </ul>
+                """
 
     def _initial_view(self):
         self._model.fetch_data() 
@@ -192,72 +211,64 @@ class UndiPlotWidget(ipw.VBox):
         This will produce plots for both results of the polarization, both for the convergence of it.
         """
 
-        self.fig.data = ()
         direction = self._model.directions
         field_direction = self._model.field_direction
         if self._model.mode == "plot":
-            quantity_to_iterate = self._model.selected_fields
-            self.fig.update_layout(title=f"Polarization data for the selected muon sites: {', '.join(self._model.selected_labels)}")
+            quantity = "P"
         else:
-            quantity_to_iterate = self._model.max_hdims
-            highest_index = self._model.max_hdims.index(max(self._model.max_hdims))
+            quantity = self._model.plotting_quantity
         selected_indexes = self._model.selected_indexes
         selected_labels = self._model.selected_labels
-        ylabel=None
-        
-
-        if len(self._model.selected_indexes) != len(self._model.selected_labels):
-            raise ValueError(self._model.selected_indexes, self._model.selected_labels)
+        ylabel = "P(t)"
+        if "delta" in quantity:
+            ylabel = "ΔP(t)"
+        if "rel" in quantity:
+            ylabel = "Δ<sub>%</sub>P(t)"
         
-        for muon_index, muon_label in zip(selected_indexes,selected_labels):
-            
-            muon_index_string = f" (site {muon_label})" if len(selected_labels) > 1 else ""
-            
-            #for index in range(len(self._model.muons[str(muon_index)].results)):
-            for value in quantity_to_iterate:
-                # shell_node = node #orm.load_node(2582)
+        curves = {}
+        with self.fig.batch_update():
+            if self._model.mode == "plot":
+                self.fig.update_layout(title=f"Polarization data for the selected muon sites: {', '.join(self._model.selected_labels)}")
+            elif len(self._model.muons.indexes) > 1:
+                self.fig.update_layout(title=f"Convergence analysis for the muon site {', '.join(selected_labels)}")
+            for muon_index, muon_label in zip(selected_indexes,selected_labels):
+                
+                muon_index_string = ""
+                if len(selected_labels) > 1 or (self._model.mode == "analysis" and len(self._model.muons.indexes) > 1):
+                    muon_index_string = f" (site {muon_label})"
+                muon = self._model.muons[str(muon_index)]
+                
                 if self._model.mode == "plot":
-                    index = self._model.muons[str(muon_index)].fields.index(value)
-                    Bmod = self._model.muons[str(muon_index)].results[index][0]["B_ext"] * 1000  # mT
-                    label = f"B<sub>ext</sub>={Bmod} mT"+muon_index_string
-                    ydata = self._model.muons[str(muon_index)].data["y"][field_direction][index][
-                        f"signal_{direction}"
-                    ]
-                    ylabel = "P(t)"
-                    title = None
-                elif self._model.mode == "analysis":
-                    index = self._model.max_hdims.index(value)
-                    to_be_plotted = self._model.plotting_quantity
-                    Bmod = self._model.muons[str(muon_index)].results[index][0]["B_ext"] * 1000  # mT
-                    label = f"max<sub>hdim</sub> = 10<sup>{int(np.log10(self._model.max_hdims[index]))}</sup>"
-                    
-                    ydata_highest = np.array(
-                        self._model.muons[str(muon_index)].data["y"][field_direction][highest_index][f"signal_{direction}"]
-                    )
-                    
-                    ydata = np.array(
-                        self._model.muons[str(muon_index)].data["y"][field_direction][index][f"signal_{direction}"]
-                    )
-                    ylabel = "P(t)"
-                    if "delta" in to_be_plotted:
-                        ydata = ydata_highest - ydata
-                        ylabel = "ΔP(t)"
-                    if "rel" in to_be_plotted:
-                        ydata /= 100 * ydata_highest
-                        ylabel = "Δ<sub>%</sub>P(t)"
-                    title = None  # "$$\Delta P(t) = P_{max\_hdim=10^9}(t) - P(t)$$"
-
-                self.fig.add_trace(
-                    go.Scatter(
-                        x=self._model.muons[str(muon_index)].data["x"],
-                        y=ydata,
-                        name=label,
-                        mode="lines",
-                        marker=dict(size=10),
-                        line=dict(width=2),
-                    ),
-                )
-                self.fig.update_layout(yaxis=dict(title=ylabel))
+                    quantity_to_iterate = [value for value in self._model.selected_fields if value in muon.fields]
+                else:
+                    # each site has its own ladder: the reference is its largest max_hdim.
+                    quantity_to_iterate = muon.max_hdims
+                    highest_index = muon.max_hdims.index(max(muon.max_hdims))
+                
+                for value in quantity_to_iterate:
+                    if self._model.mode == "plot":
+                        index = muon.fields.index(value)
+                        label = f"B<sub>ext</sub>={muon.fields[index]} mT"+muon_index_string  # mT
+                    else:
+                        index = muon.max_hdims.index(value)
+                        label = f"max<sub>hdim</sub> = 10<sup>{int(np.log10(muon.max_hdims[index]))}</sup>"+muon_index_string
+
+                    key = (str(muon_index), value, direction, field_direction, quantity)
+                    ydata = np.array(muon.data["y"][field_direction][index][f"signal_{direction}"])
+                    if self._model.mode == "analysis":
+                        ydata_highest = np.array(
+                            muon.data["y"][field_direction][highest_index][f"signal_{direction}"]
+                        )
+                        if "delta" in quantity:
+                            ydata = ydata_highest - ydata
+                        if "rel" in quantity:
+                            ydata /= 100 * ydata_highest
+                    curves[key] = (muon.data["x"], ydata, label)
+
+            self.fig.update_layout(yaxis=dict(title=ylabel))
+            self._undi_curves = curves
+            self._set_traces({**self._undi_curves, **self._get_KT_curves()})
+        self._check_trace_type()
                 
         if not self.rendered:
             self.fig.update_layout(
@@ -280,7 +291,78 @@ class UndiPlotWidget(ipw.VBox):
                         ),
                 ),
             )
-        self._on_add_KT_change()
+        
+    def _set_traces(self, curves):
+        """Show the `curves` {key: (x, y, name)}, reusing the traces already in the figure.
+        
+        The i-th trace shows the i-th curve: its x and y are sent again only if it showed another
+        curve (or another x range, see `_refresh_trace`), and the traces in excess are removed, so
+        the figure holds only the shown curves. The full resolution data are stored, and only a
+        downsampled version (see `PolarizationModel.downsample`) is sent to the figure.
+        """
+        if len(self.fig.data) > len(curves):
+            self.fig.data = self.fig.data[:len(curves)]
+        previous_keys = list(self._traces)
+        traces, full_data, trace_ranges = {}, {}, {}
+        for i, (key, (x, y, name)) in enumerate(curves.items()):
+            full_data[key] = (np.asarray(x), np.asarray(y))
+            if i < len(previous_keys) and previous_keys[i] == key:
+                trace_ranges[key] = self._trace_ranges[key]
+                traces[key] = self.fig.data[i]
+                traces[key].name = name
+                continue
+            trace_ranges[key] = self._x_range
+            x, y = self._model.downsample(x, y, self._x_range)
+            if i < len(self.fig.data):
+                self.fig.data[i].update(x=x, y=y, name=name)
+            else:
+                self.fig.add_trace(
+                    self._trace_type(
+                        x=x,
+                        y=y,
+                        name=name,
+                        mode="lines",
+                        marker=dict(size=10),
+                        line=dict(width=2),
+                    ),
+                )
+            traces[key] = self.fig.data[i]
+        self._traces, self._full_data, self._trace_ranges = traces, full_data, trace_ranges
+        for key in self._traces:
+            self._refresh_trace(key)
+    
+    def _check_trace_type(self):
+        """Switch all the traces to go.Scattergl (WebGL) if they have more than
+        `webgl_points_threshold` points, or back to go.Scatter (SVG)."""
+        n_points = sum(len(trace.x) for trace in self._traces.values())
+        trace_type = go.Scattergl if n_points > webgl_points_threshold else go.Scatter
+        if trace_type is self._trace_type:
+            return
+        self._trace_type = trace_type
+        traces = [
+            trace_type(
+                x=trace.x, y=trace.y, name=trace.name,
+                mode="lines", marker=dict(size=10), line=dict(width=2),
+            )
+            for trace in self._traces.values()
+        ]
+        self.fig.data = ()
+        self.fig.add_traces(traces)
+        self._traces = dict(zip(self._traces, self.fig.data))
+    
+    def _refresh_trace(self, key):
+        """Downsample again the trace `key`, if it was downsampled for another x range."""
+        if self._trace_ranges[key] != self._x_range:
+            x, y = self._model.downsample(*self._full_data[key], self._x_range)
+            self._traces[key].update(x=x, y=y)
+            self._trace_ranges[key] = self._x_range
+    
+    def _on_xrange_change(self, layout, x_range, autorange):
+        # zoom/pan/reset of the figure: more (or less) details are needed for the visible traces.
+        self._x_range = None if autorange or x_range is None else tuple(x_range)
+        with self.fig.batch_update():
+            for key in self._traces:
+                self._refresh_trace(key)
         
     # view
     def inject_tune_plot_box(
@@ -412,31 +494,41 @@ class UndiPlotWidget(ipw.VBox):
     def _on_plotting_quantity_change(self, change):
         self._update_plot()
         
+    # the site shown in the convergence analysis:
+    def _on_analysed_index_change(self, change):
+        self.convergence_description.value = self._get_convergence_description()
+        self._update_plot()
+        
     # if selected_muons in the findmuonwidget changes, we need to update the plot also here:
     def _on_selected_indexes_change(self, change):
         self._update_plot()
     
     def _on_add_KT_change(self, change = None):
-        
-        for muon_index, muon_label in zip(self._model.selected_indexes, self._model.selected_labels):
-            muon_index_string = f" (site {muon_label})" if len(self._model.selected_indexes) > 1 else ""
-            if self._model.plot_KT:
-                # add the trace
-                if self._model.muons[str(muon_index)].KT_output:
-                    self.KT_trace = go.Scatter(
-                            x=self._model.muons[str(muon_index)].KT_output["t"],
-                            y=self._model.muons[str(muon_index)].KT_output["KT"],
-                            name="Kubo-Toyabe" + muon_index_string,
-                            mode="lines",
-                            marker=dict(size=10),
-                            line=dict(width=2),
-                        )
-                    self.fig.add_trace(self.KT_trace)
-            else:
-                # remove the trace
-                if hasattr(self, "KT_trace"): 
-                    self.fig.data = tuple([trace for trace in self.fig.data[:-(len(self._model.selected_indexes))]])
-                    delattr(self, "KT_trace")
+        with self.fig.batch_update():
+            self._set_traces({**self._undi_curves, **self._get_KT_curves()})
+        self._check_trace_type()
+
+    def _get_KT_curves(self):
+        """The {("KT", muon index): (x, y, name)} Kubo-Toyabe curves of the selected sites, if plotted."""
+        curves = {}
+        if self._model.plot_KT:
+            for muon_index, muon_label in zip(self._model.selected_indexes, self._model.selected_labels):
+                muon_index_string = f" (site {muon_label})" if len(self._model.selected_indexes) > 1 else ""
+                KT_output = self._model.muons[str(muon_index)].KT_output
+                if KT_output:
+                    curves[("KT", str(muon_index))] = (
+                        KT_output["t"], KT_output["KT"], "Kubo-Toyabe" + muon_index_string,
+                    )
+        return curves
         
     def init_undi_plots(self):
+        # {(muon index, field or max_hdim, direction, field direction, plotted quantity): trace}, and
+        # {("KT", muon index): trace}, for the shown curves only (see `_set_traces`).
+        self._traces = {}
+        self._undi_curves = {} # {key: (x, y, name)} of the shown undi curves, at full resolution.
+        self._full_data = {} # {key: (x, y)} at full resolution.
+        self._trace_ranges = {} # {key: x range for which the trace was downsampled}
+        self._x_range = None # None is the whole curve.
+        self._trace_type = go.Scatter # or go.Scattergl, see `_check_trace_type`.
         self._update_plot()
+        self.fig.layout.xaxis.on_change(self._on_xrange_change, "range", "autorange")
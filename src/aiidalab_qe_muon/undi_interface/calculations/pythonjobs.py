@@ -1,6 +1,104 @@
 from aiida_workgraph import task
 
-@task.pythonjob(outputs=["results"])
+UNDI_DIRECTIONS = ["x", "y", "z", "powder"]
+UNDI_GEOMETRIES = ["lf", "tf"]
+
+def _undi_version():
+    """The version of the installed undi and a hash of its sources, so that the cache is invalidated
+    when undi is upgraded (or modified, e.g. in an editable install which keeps the same version)."""
+    import hashlib
+    import os
+    from importlib.metadata import PackageNotFoundError, version
+
+    import undi
+
+    try:
+        undi_version = version("undi")
+    except PackageNotFoundError:
+        undi_version = getattr(undi, "__version__", None)
+    digest = hashlib.sha256()
+    root = os.path.dirname(undi.__file__)
+    for folder, subfolders, filenames in sorted(os.walk(root)):
+        subfolders.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(".py"):
+                digest.update(os.path.relpath(os.path.join(folder, filename), root).encode())
+                with open(os.path.join(folder, filename), "rb") as handle:
+                    digest.update(handle.read())
+    return f"{undi_version}+{digest.hexdigest()}"
+
+def _undi_cache_key(
+    structure,
+    atom_as_muon = 'H',
+    cutoff = None, # Angstrom; if None, the whole structure.
+    decimals = 2, # positions are rounded to 0.01 Angstrom.
+    **settings,
+):
+    """Hash of the muon-centred cluster and of the undi settings.
+
+    By default the cluster is the whole structure given to undi, which is all the nuclei it can use
+    (however many of them its max_hdim includes): the cell and the atomic numbers and (rounded)
+    positions relative to the muon, so that the same structure translated, or relaxed within the
+    rounding, gives the same key. With a `cutoff`, only the atoms (and periodic images) within it
+    from the muon are hashed, so that the same site in different supercells also gives the same key;
+    the cutoff is part of the key, and must be larger than any cluster undi builds, otherwise
+    sites which differ only beyond it share the (wrong) results.
+    """
+    import hashlib
+    import json
+    import numpy as np
+    from ase.neighborlist import neighbor_list
+
+    muon = [i for i, symbol in enumerate(structure.get_chemical_symbols()) if symbol == atom_as_muon][-1]
+    if cutoff is None:
+        numbers = structure.numbers
+        positions = structure.positions - structure.positions[muon]
+        cell = np.round(structure.cell[:], decimals) + 0.0
+    else:
+        i, j, D = neighbor_list("ijD", structure, cutoff)
+        numbers, positions = structure.numbers[j[i == muon]], D[i == muon]
+        cell = np.zeros((0, 3))
+    cluster = np.column_stack([numbers, np.round(positions, decimals) + 0.0])  # + 0.0 avoids -0.0
+    cluster = cluster[np.lexsort(cluster.T[::-1])]
+
+    # 1e6 and 1000000 are the same max_hdim.
+    settings = {
+        key: float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+        for key, value in settings.items()
+    }
+    digest = hashlib.sha256(cluster.tobytes())
+    digest.update(cell.tobytes())
+    digest.update(json.dumps(
+        dict(settings, atom_as_muon=atom_as_muon, cutoff=cutoff, undi_version=_undi_version()),
+        sort_keys=True,
+    ).encode())
+    return digest.hexdigest()
+
+def _cached_undi_analysis(structure, cache_dir=None, cache_cutoff=None, **settings):
+    """Run `execute_undi_analysis`, reusing the results stored in `cache_dir` (if given) for the same key
+    (see `_undi_cache_key`, with `cache_cutoff` as its cutoff)."""
+    from undi.undi_analysis import execute_undi_analysis
+
+    if cache_dir is None:
+        return execute_undi_analysis(structure, **settings)
+
+    import os
+    import pickle
+
+    path = os.path.join(cache_dir, _undi_cache_key(structure, cutoff=cache_cutoff, **settings) + ".pkl")
+    if os.path.exists(path):
+        with open(path, "rb") as handle:
+            return pickle.load(handle)
+
+    results = execute_undi_analysis(structure, **settings)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write and then rename, so that concurrent jobs never read a partial file.
+    with open(f"{path}.{os.getpid()}", "wb") as handle:
+        pickle.dump(results, handle)
+    os.replace(f"{path}.{os.getpid()}", path)
+    return results
+
+@task.pythonjob(outputs=["polarization", "averaged_polarization", "metadata"])
 def undi_run(
     structure, # should be StructureData, and then in the pythonjob we deserialize into ASE. for provenance.
     B_mod = 0.0, # Units are Tesla.
@@ -9,11 +107,13 @@ def undi_run(
     convergence_check = False,
     algorithm  = 'fast',
     angular_integration_steps  = 7,
+    cache_dir = None, # if given, results are stored/reused here, keyed on the muon-centred cluster.
+    cache_cutoff = None, # Angstrom; radius of the cluster in the cache key (None: the whole structure).
 ) -> dict:
-    from undi.undi_analysis import execute_undi_analysis
-
-    results = execute_undi_analysis(
+    results = _cached_undi_analysis(
         structure,
+        cache_dir=cache_dir,
+        cache_cutoff=cache_cutoff,
         B_mod=B_mod,
         atom_as_muon=atom_as_muon,
         max_hdim=max_hdim,
@@ -22,22 +122,174 @@ def undi_run(
         angular_integration_steps=angular_integration_steps
     )
 
-    return {"results": results}
+    return _pack_undi_entries([{"B_mod": B_mod, "max_hdim": max_hdim, "results": results}])
 
-@task.pythonjob(outputs=["results"])
-def compute_KT(
-    structure,  # should be StructureData, and then in the pythonjob we deserialize into ASE. for provenance.
-):
+@task.pythonjob(outputs=["polarization", "averaged_polarization", "metadata"])
+def undi_run_batch(
+    structure, # should be StructureData, and then in the pythonjob we deserialize into ASE. for provenance.
+    B_mods = [0.0], # Units are Tesla.
+    atom_as_muon = 'H',
+    max_hdims = [10e6],
+    convergence_check = False,
+    algorithm  = 'fast',
+    angular_integration_steps  = 7,
+    cache_dir = None,
+    cache_cutoff = None,
+) -> dict:
+    """Run UNDI for all the (B_mod, max_hdim) points of a muon site in the same job.
+
+    The structure is deserialized and undi is imported only once, instead of once per point, and
+    all the points are stored in the same "polarization" array (see `_pack_undi_entries`).
+    """
+    entries = []
+    for max_hdim in max_hdims:
+        for B_mod in B_mods:
+            results = _cached_undi_analysis(
+                structure,
+                cache_dir=cache_dir,
+                cache_cutoff=cache_cutoff,
+                B_mod=B_mod,
+                atom_as_muon=atom_as_muon,
+                max_hdim=max_hdim,
+                convergence_check=convergence_check,
+                algorithm=algorithm,
+                angular_integration_steps=angular_integration_steps
+            )
+            entries.append({"B_mod": B_mod, "max_hdim": max_hdim, "results": results})
+
+    return _pack_undi_entries(entries)
+
+def _pack_undi_entries(entries):
+    """Stack the undi results of many (B_mod, max_hdim) points into the outputs of the undi pythonjobs.
+
+    The "polarization" array has shape (point, isotope combination, direction, geometry, time), with
+    directions x, y, z, powder and geometries lf, tf. Points with fewer isotope combinations are padded
+    with zeros (their "combinations" metadata lists only the actual ones). The "averaged_polarization",
+    of shape (point, direction, geometry, time), is its probability weighted average over the combinations,
+    i.e. what is plotted in the results panel.
+    """
+    import numpy as np
+
+    n_combinations = max(len(entry["results"]) for entry in entries)
+    t = entries[0]["results"][0]["t"]
+    signals = np.zeros(
+        (len(entries), n_combinations, len(UNDI_DIRECTIONS), len(UNDI_GEOMETRIES), len(t)),
+        dtype=np.float32,
+    )
+    combinations = []
+    for p, entry in enumerate(entries):
+        for c, res in enumerate(entry["results"]):
+            for d, direction in enumerate(UNDI_DIRECTIONS):
+                for g, geometry in enumerate(UNDI_GEOMETRIES):
+                    signals[p, c, d, g] = res[f"signal_{direction}_{geometry}"]
+        combinations.append([
+            {key: res[key] for key in ["cluster_isotopes", "spins", "probability"]}
+            for res in entry["results"]
+        ])
+
+    metadata = {
+        "B_mods": [float(entry["B_mod"]) for entry in entries],
+        "max_hdims": [float(entry["max_hdim"]) for entry in entries],
+        "t": [float(time) for time in t], # seconds
+        "directions": UNDI_DIRECTIONS,
+        "geometries": UNDI_GEOMETRIES,
+        "combinations": combinations,
+    }
+    weights = np.zeros(signals.shape[:2])
+    for p, point in enumerate(combinations):
+        weights[p, :len(point)] = [combination["probability"] for combination in point]
+    weights /= weights.sum(axis=1, keepdims=True)
+    averaged = np.einsum("pc,pcdgt->pdgt", weights, signals).astype(np.float32)
+
+    return {"polarization": signals, "averaged_polarization": averaged, "metadata": metadata}
+
+def _isotopic_average(results, signal="signal_z_lf"):
+    """Probability weighted average of a signal over the isotope combinations of an undi run."""
+    import numpy as np
+
+    return np.average(
+        [res[signal] for res in results],
+        weights=[res["probability"] for res in results],
+        axis=0,
+    )
+
+@task.pythonjob(outputs=["polarization", "averaged_polarization", "metadata", "max_hdims"])
+def undi_convergence_ladder(
+    structure, # should be StructureData, and then in the pythonjob we deserialize into ASE. for provenance.
+    max_hdims = [1e2, 1e4, 1e6, 1e8],
+    tolerance = 1e-2,
+    B_mod = 0.0, # Units are Tesla.
+    atom_as_muon = 'H',
+    convergence_check = False,
+    algorithm  = 'fast',
+    angular_integration_steps  = 7,
+    cache_dir = None,
+    cache_cutoff = None,
+) -> dict:
+    """Run UNDI for increasing max_hdim, stopping as soon as the polarization is converged.
+
+    The run at max_hdim[i] is converged if max_t |P_i(t) - P_{i+1}(t)| < tolerance, with P the
+    isotope averaged (zero field, z direction) polarization. The smallest converged max_hdim
+    (or the largest one, if convergence is never reached) is returned as "max_hdims", in a
+    one-element list to be used for the production runs. The "polarization" and "metadata" are the
+    same as in `undi_run_batch`, for the max_hdims which were actually computed.
+    """
+    import numpy as np
+
+    entries = []
+    selected = None
+    for max_hdim in sorted(max_hdims):
+        results = _cached_undi_analysis(
+            structure,
+            cache_dir=cache_dir,
+            cache_cutoff=cache_cutoff,
+            B_mod=B_mod,
+            atom_as_muon=atom_as_muon,
+            max_hdim=max_hdim,
+            convergence_check=convergence_check,
+            algorithm=algorithm,
+            angular_integration_steps=angular_integration_steps
+        )
+        entries.append({"B_mod": B_mod, "max_hdim": max_hdim, "results": results})
+
+        if len(entries) > 1:
+            delta = np.max(np.abs(
+                _isotopic_average(entries[-1]["results"]) - _isotopic_average(entries[-2]["results"])
+            ))
+            if delta < tolerance:
+                selected = entries[-2]["max_hdim"]
+                break
+
+    if selected is None:
+        selected = entries[-1]["max_hdim"]
+
+    return dict(_pack_undi_entries(entries), max_hdims=[selected])
+
+@task(
+    inputs=[{"name": "structures", "identifier": "workgraph.namespace", "metadata": {"dynamic": True}}],
+    outputs=["result"],
+)
+def compute_KT_sites(structures):
+    """Zero field Kubo-Toyabe for all the sites at once, run in the daemon (no pythonjob needed).
+
+    The result is a dictionary {site: {"t": times (microseconds), "KT": polarization, "second_moment": s^-2,
+    "second_moment_error": s^-2}}, as the one of `aiidalab_qe_muon.utils.KT.kubo_toyabe_result` for each site.
+    """
     import numpy as np
-    from undi.kubo_toyabe.KT import compute_second_moments, kubo_toyabe
+    from aiidalab_qe_muon.utils.KT import batched_kubo_toyabe, second_moment
 
     t = np.linspace(0, 20e-6, 1000)  # time is seconds
-    sm = compute_second_moments(structure)
-    KT = kubo_toyabe(t, np.sum(list(sm.values())))
+    second_moments = [second_moment(atoms, tail_correction=True) for atoms in structures.values()]
+    KT = batched_kubo_toyabe(t, np.array([S2 for S2, _ in second_moments]))
 
     return {
-        "results": {
-            "t": (np.array(t)*1e6).tolist(), # this time is in microseconds
-            "KT": KT,
+        "result": {
+            idx: {
+                "t": (t*1e6).tolist(), # this time is in microseconds
+                "KT": KT[i].tolist(),
+                "second_moment": second_moments[i][0],
+                "second_moment_error": second_moments[i][1],
+            }
+            for i, idx in enumerate(structures)
         },
     }
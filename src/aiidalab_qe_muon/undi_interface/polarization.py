@@ -0,0 +1,486 @@
+"""Reading of the UNDI and Kubo-Toyabe results of the polarization workgraphs (see `MultiSites`).
+
+Plain functions and classes, without any ipywidgets front-end: they are used both by the results
+panel (`PolarizationModel`) and by the headless export (`aiidalab_qe_muon.utils.export`).
+"""
+
+import collections.abc
+import functools
+
+import numpy as np
+from aiida import orm
+from aiida.common.extendeddicts import AttributeDict
+
+from aiidalab_qe_muon.undi_interface.utils import query_called, query_links
+
+DIRECTIONS = ["z", "x", "y", "powder"]
+GEOMETRIES = ["lf", "tf"]
+
+
+class LazyCombination(dict):
+    """Results of an isotope combination, whose signals are read from the "polarization" array only if needed.
+
+    `load_signals` returns the (point, combination, direction, geometry, time) array of the node, and is
+    shared by all the combinations of the node, so that the array is read at most once.
+    """
+
+    def __init__(self, load_signals, point, combination, metadata, **kwargs):
+        super().__init__(**kwargs)
+        self._load_signals = load_signals
+        self._index = (point, combination)
+        self._metadata = metadata
+
+    def __missing__(self, key):
+        if not key.startswith("signal_"):
+            raise KeyError(key)
+        direction, geometry = key.replace("signal_", "").split("_")
+        self[key] = self._load_signals()[
+            self._index
+            + (self._metadata["directions"].index(direction), self._metadata["geometries"].index(geometry))
+        ]
+        return self[key]
+
+
+class LazySites(collections.abc.Mapping):
+    """{muon_index: site results}, where each site is loaded by `load_site(muon_index)` only when accessed.
+
+    The last `maxsize` loaded sites are kept (least recently used are dropped first), and `aliases`
+    maps symmetry equivalent sites to the index of their representative, whose results they share.
+    These are the only copies of the unpacked results: `maxsize` should be at least the number of
+    sites used together (e.g. plotted), not to load them again each time.
+    """
+
+    def __init__(self, indexes, load_site, aliases={}, maxsize=8):
+        self._indexes = list(indexes)
+        self._load_site = load_site
+        self._aliases = dict(aliases)
+        self._maxsize = maxsize
+        self._loaded = collections.OrderedDict()
+
+    def __getitem__(self, muon_index):
+        muon_index = self._aliases.get(muon_index, muon_index)
+        if muon_index not in self._indexes:
+            raise KeyError(muon_index)
+        if muon_index in self._loaded:
+            self._loaded.move_to_end(muon_index)
+        else:
+            self._loaded[muon_index] = self._load_site(muon_index)
+            if len(self._loaded) > self._maxsize:
+                self._loaded.popitem(last=False)
+        return self._loaded[muon_index]
+
+    def __iter__(self):
+        return iter(self._indexes + list(self._aliases))
+
+    def __len__(self):
+        return len(self._indexes) + len(self._aliases)
+
+    def loaded_values(self):
+        return list(self._loaded.values())
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        self._maxsize = maxsize
+        while len(self._loaded) > self._maxsize:
+            self._loaded.popitem(last=False)
+
+    @property
+    def indexes(self):
+        """The computed sites, i.e. without the aliases."""
+        return list(self._indexes)
+
+    @property
+    def aliases(self):
+        return dict(self._aliases)
+
+
+class PolarizationData:
+    """Undi and KT nodes of a MultiSites workgraph, and their unpacked results, as read from the database.
+
+    It is shared by all the models showing the same workgraph (e.g. the "plot" and "analysis" ones of
+    `PolarizationModel`, see `get_polarization_data`), so that the workgraph is traversed only once;
+    each model then unpacks only the nodes it needs (see `load_site`), and keeps the sites it loaded
+    (see `LazySites`).
+    """
+
+    def __init__(self, workflow):
+        # the called processes, one query per level: sub-graphs of the sites, undi sub-graphs, pythonjobs.
+        calls, parents = {}, [workflow.pk]
+        while parents:
+            level = query_called(parents)
+            for caller, label, node in level:
+                calls.setdefault(caller, []).append((label, node))
+            parents = [node.pk for _, _, node in level if isinstance(node, orm.WorkflowNode)]
+
+        self.nodes = [node for _, node in calls.get(workflow.pk, [])]
+        self.equivalent_sites = workflow.base.extras.get("equivalent_sites", {})
+        self.site_nodes = self.get_site_nodes(calls, workflow.pk)
+        self._called = {
+            pk: [node for _, node in called] for pk, called in calls.items() if pk != workflow.pk
+        }
+
+        # and all the outputs and inputs of the pythonjobs we need, in two more queries.
+        jobs = [node.pk for called in calls.values() for _, node in called if not isinstance(node, orm.WorkflowNode)]
+        self.outputs = query_links(jobs, ["polarization", "averaged_polarization", "metadata", "max_hdims", "result"])
+        self.function_inputs = {
+            pk: {label.replace("function_inputs__", ""): node for label, node in inputs.items()}
+            for pk, inputs in query_links(
+                jobs, ["function_inputs__B_mod", "function_inputs__max_hdim"], incoming=True,
+            ).items()
+        }
+        self._KT_outputs = {}
+
+    @staticmethod
+    def get_site_nodes(calls, workflow_pk):
+        """Return {muon_index: {label: node}} with the "undi_runs", "convergence_check" (if any) and
+        "KuboToyabe_run" nodes of each site.
+        
+        `calls` are the {caller pk: [(call link label, called node)]} of the MultiSites workgraph and
+        its descendants: the workgraph calls either one sub-graph per site (labelled
+        "polarization_structure_{muon_index}"), or, for the flat workgraph, directly the
+        pythonjobs, labelled "{label}_{muon_index}", plus a single KT task for all the sites.
+        A single site workgraph (UndiAndKuboToyabe) is its only site, with index "0".
+        """
+        sites, KT_node = {}, None
+        site_labels = ["undi_runs", "convergence_check", "KuboToyabe_run"]
+        if any(label in site_labels[:2] for label, _ in calls.get(workflow_pk, [])):
+            return {"0": {label: node for label, node in calls[workflow_pk] if label in site_labels}}
+        for call_link_label, node in calls.get(workflow_pk, []):
+            if call_link_label == "KuboToyabe_run":
+                KT_node = node
+            elif not isinstance(node, orm.WorkflowNode):
+                label, muon_index = call_link_label.rsplit("_", 1)
+                sites.setdefault(muon_index, {})[label] = node
+            else:
+                muon_index = call_link_label.replace("polarization_structure_","")
+                sites[muon_index] = {
+                    label: called for label, called in calls.get(node.pk, [])
+                    if label in site_labels
+                }
+        if KT_node:
+            for site in sites.values():
+                site["KuboToyabe_run"] = KT_node
+        return sites
+
+    def called(self, node):
+        """The undi pythonjobs of a site task: the node itself, or the ones called by the sub-graph."""
+        # the early stopping convergence check is a single pythonjob, not a sub-graph.
+        return self._called.get(node.pk, [node])
+
+    def unpack(self, nodes):
+        """Same as `unpack_undi_nodes`, from the outputs and inputs already queried.
+
+        Nothing is kept here: the unpacked results are only kept by the sites which use them.
+        """
+        unpacked = [unpack_undi_outputs(self.outputs[node.pk], self.function_inputs[node.pk]) for node in nodes]
+        return tuple(
+            [item for outputs in unpacked for item in outputs[i]] for i in range(4)
+        )
+
+    def KT_output(self, node):
+        if node.pk not in self._KT_outputs:
+            self._KT_outputs[node.pk] = self.outputs[node.pk]["result"].get_dict()
+        return self._KT_outputs[node.pk]
+
+
+def get_polarization_data(workflow_pk):
+    """The `PolarizationData` of the workgraph with pk `workflow_pk`, shared in the whole process.
+    
+    Only sealed workgraphs are cached (see `_get_sealed_polarization_data`): a running one may still
+    add results, so it is read again each time.
+    """
+    workflow = orm.load_node(workflow_pk)
+    if not workflow.is_sealed:
+        return PolarizationData(workflow)
+    return _get_sealed_polarization_data(workflow_pk)
+
+
+@functools.lru_cache(maxsize=2)
+def _get_sealed_polarization_data(workflow_pk):
+    # the "plot" and "analysis" models of the opened results, and of the previous ones.
+    return PolarizationData(orm.load_node(workflow_pk))
+
+
+def get_polarization_workflow(polarization):
+    """The MultiSites workgraph which computed the "polarization" output (the KT results) of an
+    ImplantMuonWorkChain."""
+    caller = polarization.creator.caller
+    if "polarization_structure_" in (caller.base.attributes.all.get("metadata_inputs") or {}).get("metadata",{}).get("call_link_label",""):
+        caller = caller.caller # not the flat workgraph: KT is computed in the site sub-graph.
+    return caller
+
+
+def get_sites(data, mode="plot", load=None, maxsize=8):
+    """The `LazySites` of the `PolarizationData` `data`, each site being loaded by `load(muon_index)`
+    (by default, `load_site`).
+
+    In "analysis" mode, only the sites with a convergence check are there; in "plot" mode, all the
+    sites, and the symmetry equivalent ones which were not computed are aliases of their representative.
+    """
+    if load is None:
+        load = functools.partial(load_site, data, mode=mode)
+    indexes = [
+        muon_index for muon_index, site in data.site_nodes.items()
+        if mode == "plot" or "convergence_check" in site
+    ]
+    aliases = {}
+    if mode == "plot":
+        aliases = {
+            muon_index: representative for muon_index, representative in data.equivalent_sites.items()
+            if muon_index not in indexes and representative in indexes
+        }
+    return LazySites(indexes, load, aliases=aliases, maxsize=maxsize)
+
+
+def load_site(data, muon_index, mode="plot"):
+    """Load the results of the site `muon_index` from the `PolarizationData` `data`.
+
+    Returns an AttributeDict with the sorted "fields" (mT) and their "max_hdims" (in "plot" mode), or
+    the sorted max_hdims of the convergence check (in "analysis" mode, with the "production_max_hdim"),
+    the undi "results" and isotopic "averages" of each of them, the "isotopes" combinations, the
+    "KT_output" (in "plot" mode) and the "data" to be plotted (see `polarization_plot_data`).
+    """
+    site = data.site_nodes[muon_index]
+    muon = AttributeDict()
+
+    search = "undi_runs"
+    if mode == "analysis":
+        search = "convergence_check"
+
+    # with an adaptive max_hdim and only B=0, there are no undi_runs: the ladder has it all.
+    search_node = site.get(search)
+    fields, max_hdims, results, averages = data.unpack(
+        data.called(search_node) if search_node else []
+    )
+    search_outputs = data.outputs.get(search_node.pk, {}) if search_node else {}
+    ladder_outputs = data.outputs.get(site["convergence_check"].pk, {}) if "convergence_check" in site else {}
+    if mode == "plot" and "max_hdims" in ladder_outputs and 0 not in fields:
+        # with an adaptive max_hdim, the zero field run at the selected max_hdim is the one of the ladder.
+        selected_max_hdim = int(ladder_outputs["max_hdims"].get_list()[0])
+        for B_mod, max_hdim, result, average in zip(*data.unpack([site["convergence_check"]])):
+            if B_mod == 0 and max_hdim == selected_max_hdim:
+                fields.append(B_mod)
+                max_hdims.append(max_hdim)
+                results.append(result)
+                averages.append(average)
+    if mode == "analysis" and "max_hdims" not in search_outputs:
+        # the zero field run at the production max_hdim is not repeated in the convergence check.
+        for B_mod, max_hdim, result, average in zip(*data.unpack(data.called(site["undi_runs"]))):
+            if B_mod == 0 and max_hdim not in max_hdims:
+                fields.append(B_mod)
+                max_hdims.append(max_hdim)
+                results.append(result)
+                averages.append(average)
+    fields = [B_mod * 1000 for B_mod in fields]  # mT
+    muon.isotopes = [
+        [res["cluster_isotopes"], res["spins"], res["probability"]]
+        for res in results[0]
+    ]
+
+    if mode == "plot":
+        KT_output = data.KT_output(site["KuboToyabe_run"])
+        # in the flat workgraph, a single KT task stores the results of all the sites.
+        muon.KT_output = KT_output.get(muon_index, KT_output)
+    
+    # re-ordering all the results according to the fields or the max_hdim.
+    if mode == "plot":
+        sorted_order = np.argsort(fields)
+    else:
+        sorted_order = np.argsort(max_hdims)
+    muon.fields = [fields[i] for i in sorted_order]
+    muon.max_hdims = [max_hdims[i] for i in sorted_order]
+    if mode == "analysis":
+        if "max_hdims" in search_outputs:
+            muon.production_max_hdim = int(search_outputs["max_hdims"].get_list()[0])
+        else:
+            muon.production_max_hdim = muon.max_hdims[-2]
+    
+    muon.results = [results[i] for i in sorted_order]
+    muon.averages = (
+        [averages[i] for i in sorted_order] if all(average is not None for average in averages) else None
+    )
+    muon.data = polarization_plot_data(muon, mode=mode)
+    return muon
+
+
+def unpack_undi_nodes(nodes):
+    """Return the B_mod (T), max_hdim, undi results and isotopic averages of each (B_mod, max_hdim) point.
+    
+    Nodes are either single point pythonjobs, or batched ones (one job for all the points
+    of a site, or the convergence ladder). Older nodes output a list of entries with the "B_mod",
+    "max_hdim" and "results", and have no isotopic averages (None).
+    """
+    fields, max_hdims, results, averages = [], [], [], []
+    for node in nodes:
+        for B_mod, max_hdim, result, average in zip(
+            *unpack_undi_outputs(node.outputs, node.inputs.function_inputs)
+        ):
+            fields.append(B_mod)
+            max_hdims.append(max_hdim)
+            results.append(result)
+            averages.append(average)
+    return fields, max_hdims, results, averages
+
+
+def unpack_undi_outputs(outputs, function_inputs):
+    """Same as `unpack_undi_nodes`, for a single node given its outputs and its "function_inputs"
+    (mappings of link labels to nodes, like `node.outputs`)."""
+    if "polarization" in outputs:
+        return unpack_polarization_arrays(outputs)
+    elif "max_hdim" not in function_inputs:
+        entries = outputs["result"].get_list()
+        return (
+            [entry["B_mod"] for entry in entries],
+            [int(entry["max_hdim"]) for entry in entries],
+            [entry["results"] for entry in entries],
+            [None] * len(entries),
+        )
+    return (
+        [function_inputs["B_mod"].value],
+        [int(function_inputs["max_hdim"].value)],
+        [outputs["result"].get_list()],
+        [None],
+    )
+
+
+def unpack_polarization_arrays(outputs):
+    """Same as `unpack_undi_outputs`, for the outputs with the "polarization" array and its "metadata".
+    
+    The per-combination signals are views of the (point, combination, direction, geometry, time)
+    array, which is read only when one of them is accessed (see `LazyCombination`). The isotopic
+    averages are views of the "averaged_polarization" array, if the node has it.
+    """
+    metadata = outputs["metadata"].get_dict()
+    load_signals = functools.lru_cache(maxsize=None)(outputs["polarization"].get_array)
+    results = [
+        [
+            LazyCombination(load_signals, p, c, metadata, t=metadata["t"], B_ext=B_mod, **combination)
+            for c, combination in enumerate(combinations)
+        ]
+        for p, (B_mod, combinations) in enumerate(zip(metadata["B_mods"], metadata["combinations"]))
+    ]
+    
+    averages = [None] * len(results)
+    if "averaged_polarization" in outputs:
+        averaged = outputs["averaged_polarization"].get_array()
+        averages = [
+            {
+                f"signal_{direction}_{geometry}": averaged[p, d, g]
+                for d, direction in enumerate(metadata["directions"])
+                for g, geometry in enumerate(metadata["geometries"])
+            }
+            for p in range(len(results))
+        ]
+    return metadata["B_mods"], [int(max_hdim) for max_hdim in metadata["max_hdims"]], results, averages
+
+
+def isotopic_averages(muon, field_direction="lf", directions=DIRECTIONS):
+    """Isotopic averages of the polarization of a site (see `load_site`), as a list (one element per
+    field or max_hdim) of {f"signal_{direction}": P(t)}."""
+    if muon.get("averages") is not None:
+        # already averaged at the end of the undi jobs.
+        return [
+            {
+                f"signal_{direction}": averages[f"signal_{direction}_{field_direction}"]
+                for direction in directions
+            }
+            for averages in muon.averages
+        ]
+    # stack (point, combination, direction, time) and average with the weights of each point in one go.
+    results = muon.results
+    n_combinations = max(len(point) for point in results)
+    weights = np.zeros((len(results), n_combinations))
+    signals = np.zeros((len(results), n_combinations, len(directions), len(results[0][0]["t"])))
+    for p, point in enumerate(results):
+        weights[p, :len(point)] = [res["probability"] for res in point]
+        for c, res in enumerate(point):
+            for d, direction in enumerate(directions):
+                signals[p, c, d] = res[f"signal_{direction}_{field_direction}"]
+    weights /= weights.sum(axis=1, keepdims=True)
+    averaged = np.einsum("pc,pcdt->pdt", weights, signals)
+
+    return [
+        {f"signal_{direction}": averaged[p, d] for d, direction in enumerate(directions)}
+        for p in range(len(results))
+    ]
+
+
+def polarization_plot_data(muon, mode="plot"):
+    """The data to be plotted for a site: {"x": t (μs), "y": {"lf": averages, "tf": averages}}, see
+    `isotopic_averages`. In "analysis" mode, only the z direction in longitudinal field is needed."""
+    return {
+        "y": {
+            "lf": isotopic_averages(muon, "lf", DIRECTIONS if mode == "plot" else ["z"]),
+            "tf": isotopic_averages(muon, "tf") if mode == "plot" else None,
+        },
+        "x": np.array(muon.results[0][0]["t"]) * 1e6,
+    }
+
+
+def polarization_dataframes(muons):
+    """The data of all the sites `muons` (see `get_sites`), fields, directions and geometries, as
+    {filename: DataFrame}."""
+    import pandas as pd
+
+    dataframes = {}
+    for muon_index in muons:
+        muon = muons[muon_index]
+        csv_dict = {"t (μs)": muon.data["x"]}
+        for field_direction in GEOMETRIES:
+            for i, Bvalue in enumerate(muon.fields):
+                for direction in DIRECTIONS:
+                    csv_dict[f"B={Bvalue}_mT_{direction}_{field_direction}"] = muon.data["y"][field_direction][i][
+                        f"signal_{direction}"
+                    ]
+        dataframes[f"muon_{muon_index}_polarization.csv"] = pd.DataFrame.from_dict(csv_dict)
+
+        if muon.get("KT_output"):
+            dataframes[f"muon_{muon_index}_Kubo_Toyabe.csv"] = pd.DataFrame.from_dict(
+                {"t (μs)": muon.KT_output["t"], "Kubo-Toyabe": muon.KT_output["KT"]}
+            )
+    return dataframes
+
+
+def write_polarization_hdf5(muons, file):
+    """Write the polarization of all the sites `muons` (see `get_sites`) in an HDF5 file (a path or a
+    binary file object).
+
+    For each computed site, the group "sites/{muon_index}" contains the "polarization" dataset
+    of shape (field, direction, geometry, time), chunked per field, with the "fields" (mT) and
+    "t" (μs) datasets, and the Kubo-Toyabe "KT" dataset (t, P) if available. Symmetry
+    equivalent sites are links to the group of their representative.
+
+    Requires h5py (`pip install aiidalab-qe-muon[export]`).
+    """
+    import h5py
+
+    with h5py.File(file, "w") as h5file:
+        h5file.attrs["directions"] = DIRECTIONS
+        h5file.attrs["geometries"] = GEOMETRIES
+        sites = h5file.create_group("sites")
+        for muon_index in muons.indexes:
+            muon = muons[muon_index]
+            group = sites.create_group(muon_index)
+            polarization = np.stack([
+                np.stack([
+                    np.stack([muon.data["y"][geometry][i][f"signal_{direction}"] for geometry in GEOMETRIES], axis=0)
+                    for direction in DIRECTIONS
+                ], axis=0)
+                for i in range(len(muon.fields))
+            ]).astype(np.float32)
+            group.create_dataset(
+                "polarization",
+                data=polarization,
+                chunks=(1,) + polarization.shape[1:],
+                compression="gzip",
+            )
+            group.create_dataset("fields", data=np.asarray(muon.fields, dtype=float))
+            group.create_dataset("t", data=np.asarray(muon.data["x"], dtype=float))
+            if muon.get("KT_output"):
+                group.create_dataset("KT", data=np.array([muon.KT_output["t"], muon.KT_output["KT"]], dtype=float))
+        for muon_index, representative in muons.aliases.items():
+            sites[muon_index] = sites[representative]
@@ -1,7 +1,48 @@
 
 from typing import List
+from aiida import orm
+from aiida.common.links import LinkType
 from aiida.orm import Node
 
+def query_called(pks: List[int]):
+    """Return (caller pk, call link label, called node) for all the processes called by the ones with
+    the given `pks`, in a single query (ordered by pk)."""
+    qb = orm.QueryBuilder()
+    qb.append(orm.ProcessNode, filters={"id": {"in": list(pks)}}, project="id", tag="caller")
+    qb.append(
+        orm.ProcessNode,
+        with_incoming="caller",
+        edge_filters={"type": {"in": [LinkType.CALL_CALC.value, LinkType.CALL_WORK.value]}},
+        edge_project="label",
+        edge_tag="call",
+        project="*",
+        tag="called",
+    )
+    qb.order_by({"called": "id"})
+    return [
+        (row["caller"]["id"], row["call"]["label"], row["called"]["*"])
+        for row in qb.dict()
+    ]
+
+def query_links(pks: List[int], labels: List[str], incoming: bool = False):
+    """Return {pk: {link label: node}} with the outputs (or the inputs, if `incoming`) labelled as one
+    of `labels` of the processes with the given `pks`, in a single query."""
+    qb = orm.QueryBuilder()
+    qb.append(orm.ProcessNode, filters={"id": {"in": list(pks)}}, project="id", tag="process")
+    qb.append(
+        orm.Data,
+        **{"with_outgoing" if incoming else "with_incoming": "process"},
+        edge_filters={"label": {"in": list(labels)}},
+        edge_project="label",
+        edge_tag="link",
+        project="*",
+        tag="data",
+    )
+    links = {pk: {} for pk in pks}
+    for row in qb.dict():
+        links[row["process"]["id"]][row["link"]["label"]] = row["data"]["*"]
+    return links
+
 def fetch_data(
         nodes: List[Node],
         mode: str = "plot",
@@ -13,52 +54,22 @@ def fetch_data(
 
     # workgraph case - always the case in standard situations (qe app usage)
     if len(nodes) == 1 and "workgraph" in nodes[0].process_type:
-        # this loops can be improved, for sure there is a smarter way to do this.
-        main_node = nodes[0]
-
-        search = "undi_runs"
-        if mode == "analysis":
-            search = "Convergence"
-
-        descendants = (
-            main_node.base.links.get_outgoing().get_node_by_label(search).called
-        )
-        fields = [
-            node.inputs.function_kwargs.Bmod.value * 1000 for node in descendants
-        ]  # mT
-        selected_fields = [
-            node.inputs.function_kwargs.Bmod.value * 1000 for node in descendants
-        ]  # mT
-        max_hdims = [
-            node.inputs.function_kwargs.max_hdim.value for node in descendants
-        ]
-        results = [
-            node.outputs.result.value["results"] for node in descendants
-        ]
-        isotopes = [
-            [res["cluster_isotopes"], res["spins"], res["probability"]]
-            for res in results[0]
-        ]
+        # not at module level: the polarization module imports the queries from here.
+        from aiidalab_qe_muon.undi_interface.polarization import get_polarization_data, load_site
 
-        selected_isotopes = list(range(len(isotopes)))
+        # the single site workgraph: its nodes are read with the same queries as the MultiSites one.
+        data = get_polarization_data(nodes[0].pk)
+        muon = load_site(data, next(iter(data.site_nodes)), mode=mode)
 
-        if mode == "plot":
-            KT_output = (
-                main_node.base.links.get_outgoing()
-                .get_node_by_label("KuboToyabe_run")
-                .outputs.result.get_dict()
-            )
-        else:
-            KT_output = None
-            
         return {
-                "fields": fields,
-                "selected_fields": selected_fields,
-                "max_hdims": max_hdims,
-                "results": results,
-                "isotopes": isotopes,
-                "selected_isotopes": selected_isotopes,
-                "KT_output": KT_output,
+                "fields": muon.fields,
+                "selected_fields": list(muon.fields),
+                "max_hdims": muon.max_hdims,
+                "results": muon.results,
+                "averages": muon.averages,
+                "isotopes": muon.isotopes,
+                "selected_isotopes": list(range(len(muon.isotopes))),
+                "KT_output": muon.get("KT_output"),
             }
     
     else:
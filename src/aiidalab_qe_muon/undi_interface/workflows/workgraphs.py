@@ -1,6 +1,12 @@
 import typing as t
 from aiida_workgraph import task, WorkGraph, TaskPool
-#from aiidalab_qe_muon.undi_interface.calculations.pythonjobs import undi_run, compute_KT
+from aiidalab_qe_muon.undi_interface.calculations.pythonjobs import (
+    undi_run,
+    undi_run_batch,
+    undi_convergence_ladder,
+    compute_KT_sites,
+)
+from aiidalab_qe_muon.utils.KT import kubo_toyabe_result
 
 from aiida_workgraph import task
 
@@ -15,59 +21,58 @@ def multiple_undi_analysis(
     angular_integration_steps: int = 7,
     code = None, # if None, default python3@localhost will be used.
     metadata = {"options": {"custom_scheduler_commands": "export OMP_NUM_THREADS=1"}},
+    batched: bool = False, # if True, all the (B_mod, max_hdim) points are computed in the same pythonjob.
+    cache_dir: t.Optional[str] = None, # directory (on the computer of the code) where UNDI results are cached.
+    cache_cutoff: t.Optional[float] = None, # Angstrom; radius of the muon-centred cluster in the cache key (None: the whole structure).
 ):
     
-    def undi_run(
-        structure, # should be StructureData, and then in the pythonjob we deserialize into ASE. for provenance.
-        B_mod = 0.0,
-        atom_as_muon = 'H',
-        max_hdim = 10e6,
-        convergence_check = False,
-        algorithm  = 'fast',
-        angular_integration_steps  = 7,
-        ) -> dict:
-        from undi.undi_analysis import execute_undi_analysis
-
-        results = execute_undi_analysis(
-            structure,
-            B_mod=B_mod,
-            atom_as_muon=atom_as_muon,
-            max_hdim=max_hdim,
-            convergence_check=convergence_check,
-            algorithm=algorithm,
-            angular_integration_steps=angular_integration_steps
-        )
-
-        return {"result": results}
-    
     wg = WorkGraph()
     
+    pythonjob_inputs = dict(
+        structure=structure,
+        atom_as_muon=atom_as_muon,
+        convergence_check=convergence_check,
+        algorithm=algorithm,
+        angular_integration_steps=angular_integration_steps,
+        metadata=metadata,
+        deserializers={
+            "aiida.orm.nodes.data.structure.StructureData": "aiida_pythonjob.data.deserializer.structure_data_to_atoms",
+        },
+        # override the default `AtomsData`
+        serializers={
+            "ase.atoms.Atoms": "aiida_pythonjob.data.serializer.atoms_to_structure_data"
+        },
+        code = code,
+        register_pickle_by_value=True,
+    )
+    if cache_dir is not None:
+        pythonjob_inputs["cache_dir"] = cache_dir
+    if cache_cutoff is not None:
+        pythonjob_inputs["cache_cutoff"] = cache_cutoff
+    
+    if batched:
+        # one job per site: the process startup and the structure (de)serialization are paid only once.
+        tmp = wg.add_task(
+            undi_run_batch,
+            B_mods=list(B_mods),
+            max_hdims=list(max_hdims),
+            name="batch",
+            **pythonjob_inputs,
+        )
+        wg.update_ctx({"tmp_out.batch": tmp.outputs.polarization})
+        return wg
+    
     t = 0
     for B_mod in B_mods:
         for max_hdim in max_hdims:
             tmp = wg.add_task(
-                TaskPool.workgraph.pythonjob,
-                function=undi_run,
-                structure=structure,
+                undi_run,
                 B_mod=B_mod,
                 max_hdim=max_hdim,
-                atom_as_muon=atom_as_muon,
-                convergence_check=convergence_check,
-                algorithm=algorithm,
-                angular_integration_steps=angular_integration_steps,
-                metadata=metadata,
                 name=f"iter_{t}",
-                deserializers={
-                    "aiida.orm.nodes.data.structure.StructureData": "aiida_pythonjob.data.deserializer.structure_data_to_atoms",
-                },
-                # override the default `AtomsData`
-                serializers={
-                    "ase.atoms.Atoms": "aiida_pythonjob.data.serializer.atoms_to_structure_data"
-                },
-                code = code,
-                register_pickle_by_value=True,
+                **pythonjob_inputs,
             )
-            wg.update_ctx({f"tmp_out.iter_{t}": tmp.outputs.result})
+            wg.update_ctx({f"tmp_out.iter_{t}": tmp.outputs.polarization})
             t+=1
 
     return wg
@@ -88,6 +93,10 @@ def UndiAndKuboToyabe(
     angular_integration_steps: int = 7,
     code=None, # if None, default python3@localhost will be used.
     metadata = {"options": {"custom_scheduler_commands": "export OMP_NUM_THREADS=1"}},
+    batched: bool = False,
+    hdim_tolerance: t.Optional[float] = None, # if given, the production max_hdim is chosen by the convergence check.
+    cache_dir: t.Optional[str] = None,
+    cache_cutoff: t.Optional[float] = None,
 ):
     wg = WorkGraph()
 
@@ -95,26 +104,9 @@ def UndiAndKuboToyabe(
     #if isinstance(structure, StructureData):
     #    structure = structure.get_ase()
     
-    def compute_KT(
-        structure,  # should be StructureData, and then in the pythonjob we deserialize into ASE. for provenance.
-        ):
-        import numpy as np
-        from undi.kubo_toyabe.KT import compute_second_moments, kubo_toyabe
-
-        t = np.linspace(0, 20e-6, 1000)  # time is seconds
-        sm = compute_second_moments(structure)
-        KT = kubo_toyabe(t, np.sum(list(sm.values())))
-
-        return {
-            "result": {
-                "t": (np.array(t)*1e6).tolist(), # this time is in microseconds
-                "KT": KT,
-            },
-        }
-
     KT_task = wg.add_task(
         TaskPool.workgraph.pythonjob,
-        function=compute_KT,
+        function=kubo_toyabe_result,
         structure=structure,
         name="KuboToyabe_run",
         code = code,
@@ -128,40 +120,89 @@ def UndiAndKuboToyabe(
         },
         register_pickle_by_value=True,
     )
-    wg.update_ctx({f"res.KT_task": KT_task.outputs.result})
+    wg.update_ctx({"res.KT_task": KT_task.outputs.result})
     
     # Convergence check
-    # in the future, we can add a logic to first converge, and then run UNDI for the B_mods list
-    if convergence_check:
+    # production max_hdim: fixed, max_hdims[-2:-1], or the smallest converged one.
+    production_max_hdims = max_hdims[-2:-1]
+    production_B_mods = list(B_mods)
+    if convergence_check and hdim_tolerance is not None:
+        # the ladder stops as soon as converged, and its output max_hdims is used for the undi_runs.
+        # Its zero field run at that max_hdim is shared with the undi_runs (the results model collects
+        # it from there): the ladder is then run as the production runs, without undi's convergence_check.
+        share_zero_field = any(B_mod == 0 for B_mod in B_mods)
+        if share_zero_field:
+            production_B_mods = [B_mod for B_mod in B_mods if B_mod != 0]
+        undi_conv_task = wg.add_task(
+            undi_convergence_ladder,
+            structure=structure,
+            max_hdims=list(max_hdims),
+            tolerance=hdim_tolerance,
+            atom_as_muon=atom_as_muon,
+            convergence_check=not share_zero_field,
+            algorithm=algorithm,
+            angular_integration_steps=angular_integration_steps,
+            name="convergence_check",
+            code = code,
+            metadata=metadata,
+            deserializers={
+                "aiida.orm.nodes.data.structure.StructureData": "aiida_pythonjob.data.deserializer.structure_data_to_atoms",
+            },
+            # override the default `AtomsData`
+            serializers={
+                "ase.atoms.Atoms": "aiida_pythonjob.data.serializer.atoms_to_structure_data"
+            },
+            register_pickle_by_value=True,
+            **({"cache_dir": cache_dir} if cache_dir is not None else {}),
+            **({"cache_cutoff": cache_cutoff} if cache_cutoff is not None else {}),
+        )
+        wg.update_ctx({"res.undi_conv_task": undi_conv_task.outputs.polarization})
+        production_max_hdims = undi_conv_task.outputs.max_hdims
+    elif convergence_check:
+        # the zero field run at the production max_hdim is shared with the undi_runs,
+        # so we do not compute it twice (the results model collects it from there): the ladder
+        # is then run as the production runs, without undi's convergence_check, so that all its
+        # points are computed in the same way.
+        conv_max_hdims = list(max_hdims)
+        share_zero_field = any(B_mod == 0 for B_mod in B_mods) and len(conv_max_hdims) > 1
+        if share_zero_field:
+            conv_max_hdims.pop(-2)
         undi_conv_task = wg.add_task(
             multiple_undi_analysis,
             structure=structure,
             B_mods=[0.0],
-            max_hdims=max_hdims,
+            max_hdims=conv_max_hdims,
             atom_as_muon=atom_as_muon,
-            convergence_check=convergence_check,
+            convergence_check=not share_zero_field,
             algorithm=algorithm,
             angular_integration_steps=angular_integration_steps,
             name="convergence_check",
             code = code,
             metadata=metadata,
+            batched=batched,
+            cache_dir=cache_dir,
+            cache_cutoff=cache_cutoff,
         )
-        wg.update_ctx({f"res.undi_conv_task": undi_conv_task.outputs.results})
+        wg.update_ctx({"res.undi_conv_task": undi_conv_task.outputs.results})
 
-    undi_task = wg.add_task(
-        multiple_undi_analysis,
-        structure=structure,
-        B_mods=B_mods,
-        max_hdims=max_hdims[-2:-1],
-        atom_as_muon=atom_as_muon,
-        convergence_check=False,
-        algorithm=algorithm,
-        angular_integration_steps=angular_integration_steps,
-        name="undi_runs",
-        code = code,
-        metadata=metadata,
-    )
-    wg.update_ctx({f"res.undi_task": undi_task.outputs.results})
+    if production_B_mods:
+        undi_task = wg.add_task(
+            multiple_undi_analysis,
+            structure=structure,
+            B_mods=production_B_mods,
+            max_hdims=production_max_hdims,
+            atom_as_muon=atom_as_muon,
+            convergence_check=False,
+            algorithm=algorithm,
+            angular_integration_steps=angular_integration_steps,
+            name="undi_runs",
+            code = code,
+            metadata=metadata,
+            batched=batched,
+            cache_dir=cache_dir,
+            cache_cutoff=cache_cutoff,
+        )
+        wg.update_ctx({"res.undi_task": undi_task.outputs.results})
 
     return wg
 
@@ -172,9 +213,30 @@ def MultiSites(
     B_mods: t.List[t.Union[float, int]] = [0, 2e-3, 4e-3, 6e-3, 8e-3], # Units are Tesla.
     max_hdims: t.List[t.Union[float, int]] = [10**2, 10**4, 10**6, 10**8], # we use the [-2:-1] for the undi run (not the convergence check, let's say).
     metadata = {"options": {"custom_scheduler_commands": "export OMP_NUM_THREADS=1"}}, # just a default.
+    batched: bool = False, # one pythonjob per site (and sub-graph), instead of one per (B_mod, max_hdim) point.
+    hdim_tolerance: t.Optional[float] = None, # if given, each site runs its own (early stopping) convergence check.
+    cache_dir: t.Optional[str] = None, # if given, UNDI results are reused across sites and workchains (same muon-centred cluster).
+    cache_cutoff: t.Optional[float] = None, # Angstrom; if given, the same site in different supercells shares the cached results, see `_undi_cache_key`.
+    flat: bool = False, # no nested sub-graphs: one UNDI pythonjob (one ArrayData) per site, and one KT task for all the sites.
+    max_number_jobs: t.Optional[int] = None, # maximum number of jobs running at the same time.
     ):
     
     wg = WorkGraph("PolarizationMultiSites")
+    if max_number_jobs:
+        wg.max_number_jobs = max_number_jobs
+    
+    if flat:
+        return _flat_multi_sites(
+            wg,
+            structure_group,
+            code=code,
+            B_mods=list(B_mods),
+            max_hdims=list(max_hdims),
+            metadata=metadata,
+            hdim_tolerance=hdim_tolerance,
+            cache_dir=cache_dir,
+            cache_cutoff=cache_cutoff,
+        )
     
     for i, (idx, structure) in enumerate(structure_group.items()):
         res = wg.add_task(
@@ -182,12 +244,115 @@ def MultiSites(
             structure=structure,
             B_mods=B_mods,
             max_hdims=max_hdims,
-            convergence_check=i==0,  # maybe the convergence can be done for only one site, as done here now.
+            convergence_check=i==0 or hdim_tolerance is not None,  # maybe the convergence can be done for only one site, as done here now.
             algorithm='fast',
             name=f"polarization_structure_{idx}",
             code=code,
             metadata=metadata,
+            batched=batched,
+            hdim_tolerance=hdim_tolerance,
+            cache_dir=cache_dir,
+            cache_cutoff=cache_cutoff,
         )
         wg.update_ctx({f"res.site_{idx}": res.outputs.results})
     
-    return wg
\ No newline at end of file
+    return wg
+
+def _flat_multi_sites(
+    wg,
+    structure_group,
+    code=None,
+    B_mods=[0.0],
+    max_hdims=[10**2, 10**4, 10**6, 10**8],
+    metadata=None,
+    hdim_tolerance=None,
+    cache_dir=None,
+    cache_cutoff=None,
+):
+    """Add to `wg` all the tasks of the `MultiSites` polarization, without sub-graphs.
+
+    Each site has one `undi_run_batch` job (i.e. one ArrayData), named f"undi_runs_{idx}", and a
+    f"convergence_check_{idx}" job (only for the first site, or for all the sites if `hdim_tolerance`
+    is given), as the corresponding tasks of `UndiAndKuboToyabe`.
+    A single "KuboToyabe_run" task computes the KT for all the sites.
+    """
+    pythonjob_inputs = dict(
+        atom_as_muon='H',
+        algorithm='fast',
+        angular_integration_steps=7,
+        metadata=metadata,
+        deserializers={
+            "aiida.orm.nodes.data.structure.StructureData": "aiida_pythonjob.data.deserializer.structure_data_to_atoms",
+        },
+        # override the default `AtomsData`
+        serializers={
+            "ase.atoms.Atoms": "aiida_pythonjob.data.serializer.atoms_to_structure_data"
+        },
+        code = code,
+        register_pickle_by_value=True,
+    )
+    if cache_dir is not None:
+        pythonjob_inputs["cache_dir"] = cache_dir
+    if cache_cutoff is not None:
+        pythonjob_inputs["cache_cutoff"] = cache_cutoff
+
+    KT_task = wg.add_task(
+        compute_KT_sites,
+        structures=dict(structure_group),
+        name="KuboToyabe_run",
+        deserializers={
+            "aiida.orm.nodes.data.structure.StructureData": "aiida_pythonjob.data.deserializer.structure_data_to_atoms",
+        },
+    )
+    wg.update_ctx({"res.KT_task": KT_task.outputs.result})
+
+    for i, (idx, structure) in enumerate(structure_group.items()):
+        production_max_hdims = max_hdims[-2:-1]
+        production_B_mods = list(B_mods)
+        if hdim_tolerance is not None:
+            # as in `UndiAndKuboToyabe`, the zero field run at the selected max_hdim is the one of the ladder.
+            share_zero_field = any(B_mod == 0 for B_mod in B_mods)
+            if share_zero_field:
+                production_B_mods = [B_mod for B_mod in B_mods if B_mod != 0]
+            undi_conv_task = wg.add_task(
+                undi_convergence_ladder,
+                structure=structure,
+                max_hdims=max_hdims,
+                tolerance=hdim_tolerance,
+                convergence_check=not share_zero_field,
+                name=f"convergence_check_{idx}",
+                **pythonjob_inputs,
+            )
+            production_max_hdims = undi_conv_task.outputs.max_hdims
+            wg.update_ctx({f"res.site_{idx}.undi_conv_task": undi_conv_task.outputs.polarization})
+        elif i == 0:
+            # as in `UndiAndKuboToyabe`, the zero field run at the production max_hdim is shared
+            # (and then the ladder is run without undi's convergence_check, as the production runs).
+            conv_max_hdims = list(max_hdims)
+            share_zero_field = any(B_mod == 0 for B_mod in B_mods) and len(conv_max_hdims) > 1
+            if share_zero_field:
+                conv_max_hdims.pop(-2)
+            undi_conv_task = wg.add_task(
+                undi_run_batch,
+                structure=structure,
+                B_mods=[0.0],
+                max_hdims=conv_max_hdims,
+                convergence_check=not share_zero_field,
+                name=f"convergence_check_{idx}",
+                **pythonjob_inputs,
+            )
+            wg.update_ctx({f"res.site_{idx}.undi_conv_task": undi_conv_task.outputs.polarization})
+
+        if production_B_mods:
+            undi_task = wg.add_task(
+                undi_run_batch,
+                structure=structure,
+                B_mods=production_B_mods,
+                max_hdims=production_max_hdims,
+                convergence_check=False,
+                name=f"undi_runs_{idx}",
+                **pythonjob_inputs,
+            )
+            wg.update_ctx({f"res.site_{idx}.undi_task": undi_task.outputs.polarization})
+
+    return wg
@@ -1,66 +1,247 @@
+import collections
+
 import numpy as np
-import pandas as pd
-from ase import neighborlist
 from importlib_resources import files
 
 from aiidalab_qe_muon import utils as isotopedata
 
 file = files(isotopedata) / "isotopedata.txt"
 
-info = pd.read_table(
-    file,
-    comment="%",
-    sep="\s+",
-    names=[
-        "Z",
-        "A",
-        "Stable",
-        "Symbol",
-        "Element",
-        "Spin",
-        "G_factor",
-        "Abundance",
-        "Quadrupole",
-    ],
-)
-
 munhbar = 7.622593285e6 * 2 * np.pi  # mu_N/hbar, SI
-# (2/3)(μ_0/4pi)^2 (planck2pi 2pi × 135.5 MHz/T )^2 = 5.374 021 39 × 10^(−65) kg²·m^(6)·A^(−2)·s^(−4)
+gamma_mu = 135.5388094e6 * 2 * np.pi  # muon gyromagnetic ratio, rad s^-1 T^-1
+# (2/3)(μ_0/4pi)^2 (planck2pi 2pi × 135.5 MHz/T )^2 = 5.374 021 39 × 10^(−65) kg²·m^(6)·A^(−2)·s^(−4)
 factor = 5.37402139e-5  # angstrom instead of m
 
 
+class IsotopeTable(
+    collections.namedtuple(
+        "IsotopeTable", ["offsets", "abundance", "spin", "g_factor", "second_moment_prefactor"]
+    )
+):
+    """Isotope data indexed by atomic number, in a CSR-like layout.
+
+    The isotopes of the element with atomic number Z are the entries
+    `offsets[Z]:offsets[Z+1]` of the `abundance` (percent), `spin` and `g_factor` columns.
+    `second_moment_prefactor[Z]` is the isotope average sum(a*I(I+1)*(mu_N g/hbar)^2),
+    i.e. the species dependent part of the second moment.
+    All the arrays (numpy.ndarray) are read-only.
+
+    Not a typing.NamedTuple: cloudpickle can not rebuild those when this module is pickled by value
+    (see `kubo_toyabe_result`).
+    """
+
+    __slots__ = ()
+
+    def isotopes(self, Z):
+        """Return the (abundance, spin, g_factor) rows of the isotopes of element Z."""
+        sl = slice(self.offsets[Z], self.offsets[Z + 1])
+        return np.column_stack(
+            [self.abundance[sl], self.spin[sl], self.g_factor[sl]]
+        )
+
+
+def load_isotope_table(path=file) -> IsotopeTable:
+    """Parse the EasySpin isotope database into an `IsotopeTable`."""
+    rows = []
+    with open(path) as handle:
+        for line in handle:
+            line = line.split("%")[0].split()
+            if line:
+                # Z, spin, g_factor, abundance
+                rows.append([int(line[0]), float(line[5]), float(line[6]), float(line[7])])
+
+    data = np.array(rows)
+    data = data[np.argsort(data[:, 0], kind="stable")]
+    Z = data[:, 0].astype(int)
+    spin, g_factor, abundance = data[:, 1], data[:, 2], data[:, 3]
+
+    offsets = np.zeros(Z.max() + 2, dtype=int)
+    np.add.at(offsets, Z + 1, 1)
+    offsets = np.cumsum(offsets)
+
+    second_moment_prefactor = np.zeros(Z.max() + 1)
+    np.add.at(
+        second_moment_prefactor,
+        Z,
+        (abundance / 100) * spin * (spin + 1) * (munhbar * g_factor) ** 2,
+    )
+
+    table = IsotopeTable(offsets, abundance, spin, g_factor, second_moment_prefactor)
+    for array in table:
+        array.flags.writeable = False
+    return table
+
+
+ISOTOPE_TABLE = load_isotope_table()
+
+
 def get_isotopes(Z):
-    return info[info.Z == Z][["Abundance", "Spin", "G_factor"]].to_numpy()
+    return ISOTOPE_TABLE.isotopes(Z)
+
 
+def muon_lattice_sums(
+    atms, cutoff_distances={}, default_cutoff=40, muon_Z=1, inner_fraction=None
+):
+    """Sum r^-6 over the host atoms around each muon, binned by species.
 
-def compute_second_moments(atms, cutoff_distances={}):
+    Only the muon-centred distances are computed (one pass over the periodic images
+    of all the host atoms, for all species at once), instead of building pair lists.
+
+    Parameters
+    ----------
+    atms : ase.Atoms
+        Structure containing the muon(s), represented as `muon_Z` atoms.
+    cutoff_distances : dict
+        Cutoff radius (Å) for each atomic number; species not listed use `default_cutoff`.
+    inner_fraction : float, optional
+        If given, the sums within `inner_fraction` times the cutoffs are also returned
+        (computed in the same pass), e.g. to estimate the convergence of the sums.
+
+    Returns
+    -------
+    species : numpy.array
+        Atomic numbers of the host species.
+    sums : numpy.array
+        Lattice sums with shape (muon, species), in Å^-6.
+    inner_sums : numpy.array
+        Only if `inner_fraction` is given: same as `sums`, within the reduced cutoffs.
+    """
+    numbers = atms.get_atomic_numbers()
+    is_muon = numbers == muon_Z
+    species, host_species = np.unique(numbers[~is_muon], return_inverse=True)
+    cutoffs = np.array([cutoff_distances.get(e, default_cutoff) for e in species], dtype=float)
+    if not len(species):
+        # e.g. only the muon(s) in the structure: nothing to sum.
+        sums = np.zeros((np.count_nonzero(is_muon), 0))
+        if inner_fraction is not None:
+            return species, sums, sums.copy()
+        return species, sums
+
+    pbc = atms.get_pbc()
+    scaled = atms.get_scaled_positions(wrap=False)
+    scaled[:, pbc] %= 1.0
+    cell = atms.cell.array
+    positions = scaled @ cell
+
+    # periodic images needed to cover the largest cutoff from anywhere in the cell.
+    if any(pbc):
+        spacings = 1 / np.linalg.norm(np.linalg.inv(cell), axis=0)
+    n_images = [int(np.ceil(cutoffs.max() / spacings[i])) + 1 if pbc[i] else 0 for i in range(3)]
+    translations = (
+        np.stack(
+            np.meshgrid(*[np.arange(-n, n + 1) for n in n_images], indexing="ij"),
+            axis=-1,
+        ).reshape(-1, 3)
+        @ cell
+    )
+
+    host_positions = positions[~is_muon]
+    host_cutoffs = cutoffs[host_species]
+    # keep the (translation, atom) distance matrix to ~1e6 elements at most.
+    chunk = max(1, 1000000 // max(1, len(host_positions)))
+
+    sums = np.zeros((np.count_nonzero(is_muon), len(species)))
+    inner_sums = np.zeros_like(sums)
+    for m, muon_position in enumerate(positions[is_muon]):
+        displacements = host_positions - muon_position
+        for i in range(0, len(translations), chunk):
+            r = np.linalg.norm(
+                displacements[None, :, :] + translations[i : i + chunk, None, :], axis=-1
+            )
+            mask = (r <= host_cutoffs) & (r > 0)
+            weights = np.where(mask, r, 1.0) ** -6 * mask
+            sums[m] += np.bincount(
+                np.broadcast_to(host_species, r.shape).ravel(),
+                weights=weights.ravel(),
+                minlength=len(species),
+            )
+            if inner_fraction is not None:
+                inner = r <= inner_fraction * host_cutoffs
+                inner_sums[m] += np.bincount(
+                    np.broadcast_to(host_species, r.shape).ravel(),
+                    weights=(weights * inner).ravel(),
+                    minlength=len(species),
+                )
+
+    if inner_fraction is not None:
+        return species, sums, inner_sums
+    return species, sums
+
+
+def lattice_sum_tail(atms, species, radii, muon_Z=1):
+    """Continuum estimate of the r^-6 sum beyond `radii`, for each species.
+
+    Assuming a uniform density n of each species outside the sphere of radius R,
+    the missing part of the sum is n * 4pi * int_R^inf r^-4 dr = 4pi n / (3 R^3).
+    Vanishes for non-periodic structures.
+    """
+    if not all(atms.get_pbc()):
+        return np.zeros(len(species))
+    numbers = atms.get_atomic_numbers()
+    counts = np.array([np.count_nonzero(numbers[numbers != muon_Z] == e) for e in species])
+    density = counts / atms.get_volume()
+    return 4 * np.pi * density / (3 * np.asarray(radii, dtype=float) ** 3)
+
+
+def compute_second_moments(
+    atms, cutoff_distances={}, tolerance=None, tail_correction=False, return_errors=False
+):
     """
     Compute second moments taking care of isotope averages
+
+    The r^-6 lattice sums are averaged over all the H atoms (muons) in the structure.
+    If `tolerance` is given, the cutoff is not fixed: the radius is increased from 10 Å
+    until the relative change of every species contribution is below `tolerance`
+    (the `cutoff_distances`, 40 Å by default, being the upper bound).
+
+    If `tail_correction` is True, the sums beyond the cutoffs are added analytically
+    (see `lattice_sum_tail`), and the default cutoff is reduced to 10 Å.
+    If `return_errors` is True, an error estimate for each species is also returned:
+    the change of the (tail corrected, if requested) contribution when the sum is
+    truncated at 0.8 times the cutoff.
     """
-    tot_H = np.count_nonzero(atms.get_atomic_numbers() == 1)
+    species_avg = ISOTOPE_TABLE.second_moment_prefactor
+    default_cutoff = 10 if tail_correction else 40
+    inner_fraction = 0.8
 
-    species_avg = {}
-    for e in np.unique(atms.get_atomic_numbers()):
-        if e == 1:
-            continue
+    if tolerance is None:
+        species, sums, inner_sums = muon_lattice_sums(
+            atms, cutoff_distances, default_cutoff, inner_fraction=inner_fraction
+        )
+    else:
+        radius, previous = 10.0, None
+        while True:
+            species, sums, inner_sums = muon_lattice_sums(
+                atms,
+                {
+                    e: min(radius, cutoff_distances.get(e, default_cutoff))
+                    for e in np.unique(atms.get_atomic_numbers())
+                },
+                inner_fraction=inner_fraction,
+            )
+            converged = previous is not None and np.all(
+                np.abs(sums - previous) <= tolerance * np.abs(sums)
+            )
+            if converged or radius >= max([default_cutoff, *cutoff_distances.values()]):
+                break
+            radius, previous = 1.5 * radius, sums
+        cutoff_distances = {e: min(radius, cutoff_distances.get(e, default_cutoff)) for e in species}
 
-        species_avg[e] = 0.0
-        for a in get_isotopes(e):
-            species_avg[e] += (a[0] / 100) * a[1] * (a[1] + 1) * (munhbar * a[2]) ** 2
+    sums, inner_sums = sums.mean(axis=0), inner_sums.mean(axis=0)
+    if tail_correction:
+        radii = np.array([cutoff_distances.get(e, default_cutoff) for e in species], dtype=float)
+        sums = sums + lattice_sum_tail(atms, species, radii)
+        inner_sums = inner_sums + lattice_sum_tail(atms, species, inner_fraction * radii)
 
     # compute second moments
     specie_contribs = {}
-    for e in np.unique(atms.get_atomic_numbers()):
-        if e == 1:
-            continue
-        sum = 0.5 * np.sum(
-            neighborlist.neighbor_list(
-                "d", atms, cutoff={(1, e): cutoff_distances.get(e, 40)}
-            )
-            ** -6
-        )
-        specie_contribs[e] = species_avg[e] * sum * factor / tot_H
+    errors = {}
+    for e, sum, inner_sum in zip(species, sums, inner_sums):
+        specie_contribs[e] = species_avg[e] * sum * factor
+        errors[e] = species_avg[e] * abs(sum - inner_sum) * factor
 
+    if return_errors:
+        return specie_contribs, errors
     return specie_contribs
 
 
@@ -84,4 +265,98 @@ def kubo_toyabe(tlist, Gmu_S2):
     )
 
 
+def batched_kubo_toyabe(tlist, Gmu_S2, B_lf=None):
+    """Calculates the static Gaussian Kubo-Toyabe polarization for many
+    muon sites (and, optionally, many longitudinal fields) in one pass.
+
+    Parameters
+    ----------
+    tlist : numpy.array
+        List of times (in seconds) at which the muon polarization is observed.
+    Gmu_S2 : numpy.array
+        Second moments (s^-2), one per muon site, e.g. as obtained summing the
+        values returned by `compute_second_moments` for each site.
+    B_lf : numpy.array, optional
+        Longitudinal fields (in Tesla). If None, the zero field Kubo-Toyabe is computed.
+
+    Returns
+    -------
+    numpy.array
+        Kubo-Toyabe functions for a powder, with shape (site, time) in zero field
+        and (site, field, time) if `B_lf` is provided.
+    """
+    t = np.asarray(tlist, dtype=float)
+    delta2 = np.atleast_1d(np.asarray(Gmu_S2, dtype=float))[:, None]
+
+    if B_lf is None:
+        return kubo_toyabe(t[None, :], delta2)
+
+    # (site, field, time) broadcasting
+    delta2 = delta2[:, :, None]
+    omega = gamma_mu * np.atleast_1d(np.asarray(B_lf, dtype=float))[None, :, None]
+    return _kubo_toyabe_lf(t[None, None, :], delta2, omega)
+
+
+def _kubo_toyabe_lf(t, delta2, omega):
+    """Static Gaussian Kubo-Toyabe in longitudinal field (Hayano et al., PRB 20, 850, 1979).
+
+    The integral of exp(-delta^2 tau^2 / 2) sin(omega tau) is evaluated in closed form via the
+    Faddeeva and Dawson functions, so that the result does not depend on the time sampling.
+    Where omega is negligible with respect to delta, the zero field expression is used, as the
+    closed form becomes numerically unstable in that limit.
+    """
+    from scipy.special import dawsn, wofz
+
+    delta2, omega, t = np.broadcast_arrays(delta2, omega, t)
+    zf = kubo_toyabe(t, delta2)
+
+    s = np.sqrt(0.5 * delta2)
+    use_lf = omega > 1e-4 * np.sqrt(delta2)
+    # dummy values where the LF expression is not used, to avoid divisions by zero.
+    w = np.where(use_lf, omega, 1.0)
+    s = np.where(use_lf, s, 1.0)
+
+    b = w / (2 * s)
+    gaussian = np.exp(-0.5 * delta2 * t**2)
+    integral = dawsn(b) / s - 0.5 * np.sqrt(np.pi) / s * np.imag(
+        np.exp(-(s * t) ** 2 + 1j * w * t) * wofz(b + 1j * s * t)
+    )
+    lf = (
+        1
+        - 2 * delta2 / w**2 * (1 - gaussian * np.cos(w * t))
+        + 2 * delta2**2 / w**3 * integral
+    )
+
+    return np.where(use_lf, lf, zf)
+
+
+def second_moment(atms, tail_correction=True):
+    """Total second moment (s^-2) of the muon(s) in `atms`, and its error estimate.
+
+    Sum over the species of the contributions and of the errors of `compute_second_moments`.
+    """
+    contribs, errors = compute_second_moments(atms, tail_correction=tail_correction, return_errors=True)
+    return float(sum(contribs.values())), float(sum(errors.values()))
+
+
+def kubo_toyabe_result(structure, tail_correction=True):
+    """Zero field Kubo-Toyabe of the muon in `structure` (ase.Atoms), for the "KuboToyabe_run" pythonjob.
+
+    Returns {"result": {"t": times (microseconds), "KT": polarization, "second_moment": s^-2,
+    "second_moment_error": s^-2}}. It is defined here, and not in the workgraph, so that this module
+    is pickled by value with it: the code running the job does not need aiidalab_qe_muon.
+    """
+    t = np.linspace(0, 20e-6, 1000)  # time is seconds
+    S2, error = second_moment(structure, tail_correction=tail_correction)
+
+    return {
+        "result": {
+            "t": (t * 1e6).tolist(),  # this time is in microseconds
+            "KT": kubo_toyabe(t, S2).tolist(),
+            "second_moment": S2,
+            "second_moment_error": error,
+        },
+    }
+
+
 #### end for KT
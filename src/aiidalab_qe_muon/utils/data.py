@@ -24,6 +24,9 @@ color_code = {
     "B_hf_norm": "purple",
 }
 
+# above this number of points in a figure, plotly go.Scattergl (WebGL) is used instead of go.Scatter (SVG).
+webgl_points_threshold = 5000
+
 unit_cell_explanation_text = """
 Switching to the "Compare muon sites mode", the detected muon sites are placed in the unit cell of the (unrelaxed) structure.
 <b>Note</b> that this is not resembling what is done in the simulation, where there is one supercell (not the unit one) for each different muon
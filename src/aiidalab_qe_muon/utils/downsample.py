@@ -0,0 +1,28 @@
+import numpy as np
+
+
+def minmax_downsample(x, y, n_points, x_range=None):
+    """Return the indices of the points of the curve (x, y), sorted in x, to be displayed with about `n_points` points.
+
+    Only the points within `x_range` (plus the closest ones outside, so that the curve reaches the
+    borders of the plot) are considered. If they are more than `n_points`, they are split in
+    `n_points // 4` buckets of consecutive points, and the first, last, minimum and maximum of each
+    bucket are kept, so that peaks and oscillations are not lost.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    start, stop = 0, len(x)
+    if x_range is not None:
+        start = max(np.searchsorted(x, x_range[0], side="left") - 1, 0)
+        stop = min(np.searchsorted(x, x_range[1], side="right") + 1, len(x))
+    if stop - start <= n_points:
+        return np.arange(start, stop)
+
+    n_buckets = max(n_points // 4, 1)
+    edges = np.linspace(start, stop, n_buckets + 1).astype(int)
+    bucket = np.repeat(np.arange(n_buckets), np.diff(edges))
+    # sorting by bucket and then by y, the minimum (maximum) of each bucket is its first (last) element.
+    order = start + np.lexsort((y[start:stop], bucket))
+    return np.unique(np.concatenate([
+        edges[:-1], edges[1:] - 1, order[edges[:-1] - start], order[edges[1:] - 1 - start],
+    ]))
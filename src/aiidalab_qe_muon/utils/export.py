@@ -0,0 +1,126 @@
+"""Headless export of the results of ImplantMuonWorkChains, used by `aiidalab-qe-muon export`.
+
+The same data as the download buttons of the results panel are written to files, without any
+ipywidgets front-end: for each workchain a folder with the findmuon archive and the polarization
+data of each site, as CSV files or, with the "hdf5" format, in single HDF5 files for all the sites.
+"""
+
+import pathlib
+
+from aiida import orm
+
+IMPLANT_MUON_LABEL = "ImplantMuonWorkChain"
+
+
+def get_implant_muon_workchains(pks=(), group=None):
+    """Return the pks of the ImplantMuonWorkChains given as `pks` or in the group labelled `group`.
+
+    Other workchains (e.g. the QeAppWorkChain of the app) are replaced by the ImplantMuonWorkChains
+    they called, found with a single query.
+    """
+    pks = list(pks)
+    if group is not None:
+        pks += [node.pk for node in orm.load_group(group).nodes if isinstance(node, orm.WorkflowNode)]
+    if not pks:
+        return []
+
+    qb = orm.QueryBuilder()
+    qb.append(orm.WorkflowNode, filters={"id": {"in": pks}}, project="id", tag="top")
+    qb.append(
+        orm.WorkflowNode,
+        with_ancestors="top",
+        filters={"attributes.process_label": IMPLANT_MUON_LABEL},
+        project="id",
+    )
+    descendants = {}
+    for top, implant in qb.all():
+        descendants.setdefault(top, []).append(implant)
+
+    qb = orm.QueryBuilder().append(
+        orm.WorkflowNode,
+        filters={"id": {"in": pks}, "attributes.process_label": IMPLANT_MUON_LABEL},
+        project="id",
+    )
+    implant_muons = {pk for pk, in qb.all()}
+
+    workchains = []
+    for pk in pks:
+        for implant in [pk] if pk in implant_muons else sorted(descendants.get(pk, [])):
+            if implant not in workchains:
+                workchains.append(implant)
+    return workchains
+
+
+def export_workchain(pk, output_dir, format="csv"):
+    """Write the results of the ImplantMuonWorkChain `pk` in `output_dir`/`pk`, and return the written files.
+
+    With the "hdf5" `format`, the polarization of all the sites goes in "polarization.h5" and the
+    distortions also in "distortions.h5" (besides the findmuon archive), see
+    `aiidalab_qe_muon.undi_interface.polarization.write_polarization_hdf5` and
+    `aiidalab_qe_muon.utils.findmuon.write_distortions_hdf5`.
+    """
+    node = orm.load_node(pk)
+    folder = pathlib.Path(output_dir) / str(pk)
+    folder.mkdir(parents=True, exist_ok=True)
+    written = []
+
+    if "findmuon" in node.outputs:
+        from aiidalab_qe_muon.utils.findmuon import (
+            prepare_findmuon_files,
+            write_archive,
+            write_distortions_hdf5,
+        )
+
+        files_dict = prepare_findmuon_files(node.outputs.findmuon)
+        write_archive(files_dict, folder / files_dict["filename"])
+        written.append(folder / files_dict["filename"])
+        if format == "hdf5":
+            write_distortions_hdf5(files_dict["distortions"], folder / "distortions.h5")
+            written.append(folder / "distortions.h5")
+
+    if "polarization" in node.outputs:
+        from aiidalab_qe_muon.undi_interface.polarization import (
+            get_polarization_data,
+            get_polarization_workflow,
+            get_sites,
+            polarization_dataframes,
+            write_polarization_hdf5,
+        )
+
+        data = get_polarization_data(get_polarization_workflow(node.outputs.polarization).pk)
+        muons = get_sites(data, mode="plot")
+        if format == "hdf5":
+            write_polarization_hdf5(muons, folder / "polarization.h5")
+            written.append(folder / "polarization.h5")
+        else:
+            for filename, df in polarization_dataframes(muons).items():
+                df.to_csv(folder / filename, index=False)
+                written.append(folder / filename)
+
+    return [str(path) for path in written]
+
+
+def export_workchains(pks, output_dir, jobs=1, profile=None, format="csv"):
+    """Export the workchains `pks` in `jobs` parallel worker processes.
+
+    Yields (pk, written files, error) as soon as each workchain is done: a failing workchain
+    does not stop the others.
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    from aiida import load_profile
+
+    # spawned (not forked) workers, each with its own database connection.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=load_profile,
+        initargs=(profile,),
+    ) as executor:
+        futures = {executor.submit(export_workchain, pk, output_dir, format): pk for pk in pks}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as exception:
+                yield futures[future], [], exception
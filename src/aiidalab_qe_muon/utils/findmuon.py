@@ -0,0 +1,222 @@
+"""Reading and export of the FindMuonWorkChain results, without any ipywidgets front-end.
+
+Used both by the results panel (`FindMuonModel`) and by the headless export
+(`aiidalab_qe_muon.utils.export`).
+"""
+
+import numpy as np
+from aiida import orm
+
+from aiidalab_qe_muon.utils.data import dictionary_of_names_for_html
+
+DISTORTION_COLUMNS = ["atm_distance_init", "atm_distance_final", "delta_distance", "distortion"]
+
+
+def get_structures(pks, cache=None) -> dict:
+    """Return {pk: StructureData} for the given pks.
+
+    The structures which are not already in `cache` (a {pk: StructureData} dictionary, updated
+    here) are loaded with a single query.
+    """
+    cache = {} if cache is None else cache
+    pks = [int(pk) for pk in pks]
+    missing = [pk for pk in set(pks) if pk not in cache]
+    if missing:
+        qb = orm.QueryBuilder().append(
+            orm.StructureData, filters={"id": {"in": missing}}, project=["id", "*"]
+        )
+        cache.update(dict(qb.all()))
+    return {pk: cache[pk] for pk in pks}
+
+
+def get_ase_structures(pks, cache=None, ase_cache=None) -> dict:
+    """Same as `get_structures`, but returns ase.Atoms (also cached, in `ase_cache`)."""
+    ase_cache = {} if ase_cache is None else ase_cache
+    structures = get_structures(pks, cache)
+    for pk, structure in structures.items():
+        if pk not in ase_cache:
+            ase_cache[pk] = structure.get_ase()
+    return {pk: ase_cache[pk] for pk in structures}
+
+
+def build_distortion_array(distortions):
+    """Store the distortions of all the sites in a single structured array.
+
+    `distortions` is {site: {element: {column: list}}}, as exported from the FindMuonWorkChain.
+    The array has the "site" and "element" fields plus a float field for each column
+    (atm_distance_init, atm_distance_final, delta_distance, distortion), with the atoms
+    of a site, and of each element in it, contiguous. Also returns the slices of the array
+    {site: slice} and {site: {element: slice}}, with string site keys.
+    """
+    site_slices, slices, sites, elements = {}, {}, [], []
+    columns = {column: [] for column in DISTORTION_COLUMNS}
+    start = 0
+    for site, per_element in distortions.items():
+        slices[str(site)] = {}
+        site_start = start
+        for element, data in per_element.items():
+            n_atoms = len(data["atm_distance_init"])
+            slices[str(site)][element] = slice(start, start + n_atoms)
+            start += n_atoms
+            sites.append(str(site))
+            elements.append(element)
+            for column in DISTORTION_COLUMNS:
+                columns[column].append(np.asarray(data[column], dtype=float))
+        site_slices[str(site)] = slice(site_start, start)
+
+    counts = [element_slice.stop - element_slice.start for site in slices.values() for element_slice in site.values()]
+    string_length = max([len(label) for label in sites + elements] + [1])
+    array = np.empty(
+        start,
+        dtype=[("site", f"U{string_length}"), ("element", f"U{string_length}")]
+        + [(column, float) for column in DISTORTION_COLUMNS],
+    )
+    array["site"] = np.repeat(sites, counts)
+    array["element"] = np.repeat(elements, counts)
+    for column in DISTORTION_COLUMNS:
+        array[column] = np.concatenate([np.empty(0)] + columns[column])
+    return array, site_slices, slices
+
+
+def distortion_dataframes(table_all, distortion_array, distortion_slices):
+    """The distortions of each site of `table_all` (the findmuon table before clustering), as
+    {label: DataFrame} sorted by the initial distance from the muon."""
+    import pandas as pd
+
+    distortions_df = {}
+    for index, label in zip(table_all["muon_index"], table_all["label"]):
+        site = distortion_array[distortion_slices[str(index)]]
+        df = pd.DataFrame({
+            "atm_distance_init": site["atm_distance_init"],
+            "atm_distance_final": site["atm_distance_final"],
+            "distortion": site["distortion"],
+            "delta_distances": site["delta_distance"],
+            "element": site["element"].astype(object),
+        }).sort_values(by="atm_distance_init")
+        distortions_df[label] = df
+
+    return distortions_df
+
+
+def table_legend(B_fields=True, advanced_table=False, download_mode=False) -> str:
+    """The legend of the findmuon table (as html), or the README of the export if `download_mode`."""
+    from importlib_resources import files
+    from jinja2 import Environment
+
+    # not via `aiidalab_qe_muon.app.static`, which would import the whole app.
+    table_legend_template = (
+        files("aiidalab_qe_muon") / "app" / "static" / "templates" / "table_legend.html.j2"
+    ).read_text()
+    return Environment().from_string(table_legend_template).render(
+        {"B_fields": B_fields,
+         "advanced_table": advanced_table,
+         "data": dictionary_of_names_for_html,
+         "download_mode": download_mode,
+        }
+    )
+
+
+def prepare_findmuon_files(
+    findmuon,
+    findmuon_data=None,
+    advanced_table=False,
+    structures=None,
+    ase_structures=None,
+    distortions=None,
+) -> dict:
+    """The content of the findmuon export (see `write_archive`) of the `findmuon` outputs namespace
+    of an ImplantMuonWorkChain.
+
+    `findmuon_data` (as from `export_findmuon_data`), the `structures` and `ase_structures` caches
+    (see `get_ase_structures`) and the `distortions` (see `distortion_dataframes`) are computed
+    if not given.
+    """
+    if findmuon_data is None:
+        from aiida_muon.utils.export_findmuon import export_findmuon_data
+
+        findmuon_data = export_findmuon_data(findmuon)
+    structures = {} if structures is None else structures
+    if distortions is None:
+        distortion_array, distortion_slices, _ = build_distortion_array(findmuon_data["distortions"])
+        distortions = distortion_dataframes(findmuon_data["table_all"], distortion_array, distortion_slices)
+
+    # (all) the structures as ase atoms objects
+    table_all = findmuon_data["table_all"]
+    ase_by_pk = get_ase_structures(table_all["structure_id_pk"], structures, ase_structures)
+    structures_dict = {
+        label: ase_by_pk[int(node_id)]
+        for label, node_id in zip(table_all["label"], table_all["structure_id_pk"])
+    }
+    structures_dict["unit_cell"] = findmuon_data["unit_cell"].get_ase()
+    structures_dict["unit_cell_all"] = findmuon_data["unit_cell_all"].get_ase()
+    structures_dict["supercell_all"] = findmuon_data["supercell_all"].get_ase()
+
+    table = findmuon_data["table"]
+    pk = int(table["structure_id_pk"].iloc[0])
+    formula = get_structures([pk], structures)[pk].get_formula()
+    workflow_pk = findmuon.all_index_uuid.creator.caller.caller.caller.pk
+    return {
+        "table": table,
+        "table_all": table_all,
+        "structures": structures_dict,
+        "filename": f"exported_mu_res_{formula}_WorkflowID_{workflow_pk}.zip",
+        "distortions": distortions,
+        "readme": table_legend(
+            B_fields="Bdip_norm" in table.columns.tolist(), advanced_table=advanced_table, download_mode=True,
+        ),
+    }
+
+
+def write_archive(files_dict, file):
+    """Write the zip archive with the exported data (see `prepare_findmuon_files`) into `file`
+    (a path or a binary file object).
+
+    Each table, structure and distortion is serialized in memory and written directly as an
+    entry of the archive.
+    """
+    import io
+    import zipfile
+
+    with zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        # Tables
+        archive.writestr("Summary_table.csv", files_dict["table"].drop(columns="muon_index").to_csv(index=True))
+        archive.writestr("Summary_table_before_clustering.csv", files_dict["table_all"].drop(columns="muon_index").to_csv(index=True))
+
+        # Structures
+        for label, structure in files_dict["structures"].items():
+            if label == "unit_cell":
+                filename = "Allsites_unitcell.cif"
+            elif label == "unit_cell_all":
+                filename = "Allsites_before_clustering_unitcell.cif"
+            elif label == "supercell_all":
+                filename = "Allsites_before_clustering_supercell.cif"
+            else:
+                filename = f"Supercell_{label}.cif"
+            cif = io.BytesIO()
+            structure.write(cif, format="cif")
+            archive.writestr(filename, cif.getvalue())
+
+        # Distortions
+        for label, df in files_dict["distortions"].items():
+            archive.writestr(f"Distortion_supercell_{label}.csv", df.to_csv(index=False))
+
+        # README
+        archive.writestr("README.txt", files_dict["readme"])
+
+
+def write_distortions_hdf5(distortions_df, file):
+    """Write the distortions of all the sites (see `distortion_dataframes`) in an HDF5 file (a path
+    or a binary file object), one group per site label with one dataset per column.
+
+    Requires h5py (`pip install aiidalab-qe-muon[export]`).
+    """
+    import h5py
+
+    with h5py.File(file, "w") as h5file:
+        for label, df in distortions_df.items():
+            group = h5file.create_group(str(label))
+            for column in df.columns:
+                values = df[column].to_numpy()
+                if values.dtype == object or values.dtype.kind == "U":
+                    values = values.astype(h5py.string_dtype())
+                group.create_dataset(column, data=values)
@@ -0,0 +1,49 @@
+import numpy as np
+import spglib
+from ase.neighborlist import neighbor_list
+
+
+def group_equivalent_sites(sites, unitcell, tolerance=0.05, cutoff=6.0):
+    """Return the representative site of each of the `sites` ({idx: ase.Atoms supercell with the muon as the
+    last H}), as {idx: representative_idx}.
+
+    Two sites are equivalent if a rotation of the space group of the `unitcell` (ase.Atoms) maps the
+    muon-centred environment of one onto the other, i.e. each atom within `cutoff` - `tolerance` from the muon
+    has an atom of the same species within `tolerance` in the other environment. The supercells of the sites
+    are assumed to have the same orientation as `unitcell`, as is the case for the FindMuonWorkChain.
+    """
+    symmetry = spglib.get_symmetry(
+        (unitcell.cell[:], unitcell.get_scaled_positions(), unitcell.numbers),
+    )
+    # cartesian rotations: the translations do not matter for the muon-centred environment.
+    lattice = unitcell.cell[:].T
+    rotations = np.unique(
+        np.round([lattice @ rotation @ np.linalg.inv(lattice) for rotation in symmetry["rotations"]], 8),
+        axis=0,
+    )
+
+    environments = {}
+    for idx, atoms in sites.items():
+        muon = [i for i, symbol in enumerate(atoms.get_chemical_symbols()) if symbol == "H"][-1]
+        i, j, D = neighbor_list("ijD", atoms, cutoff)
+        environments[idx] = (atoms.numbers[j[i == muon]], D[i == muon])
+
+    def covered(numbers_a, positions_a, numbers_b, positions_b):
+        inner = np.linalg.norm(positions_a, axis=1) < cutoff - tolerance
+        distances = np.linalg.norm(positions_a[inner, None] - positions_b[None], axis=-1)
+        distances[numbers_a[inner, None] != numbers_b[None]] = np.inf
+        return np.all(distances.min(axis=1, initial=np.inf) < tolerance)
+
+    def equivalent(env_a, env_b):
+        return any(
+            covered(env_a[0], env_a[1] @ rotation.T, *env_b) and covered(*env_b, env_a[0], env_a[1] @ rotation.T)
+            for rotation in rotations
+        )
+
+    representatives = {}
+    for idx, environment in environments.items():
+        representatives[idx] = next(
+            (rep for rep in dict.fromkeys(representatives.values()) if equivalent(environments[rep], environment)),
+            idx,
+        )
+    return representatives
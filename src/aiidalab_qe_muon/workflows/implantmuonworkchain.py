@@ -14,6 +14,8 @@ from aiidalab_qe_muon.undi_interface.workflows.workgraphs import (
 
 from aiida_quantumespresso.data.hubbard_structure import HubbardStructureData
 
+from aiidalab_qe_muon.utils.symmetry import group_equivalent_sites
+
 MusconvWorkChain = WorkflowFactory("impuritysupercellconv")
 FindMuonWorkChain = WorkflowFactory("muon.find_muon")
 PwRelaxWorkChain = WorkflowFactory("quantumespresso.pw.relax")
@@ -72,6 +74,53 @@ class ImplantMuonWorkChain(WorkChain):
             help="The list of max_dims to compute the polarization convergence.",
         )
         
+        spec.input(
+            "undi_batched",
+            valid_type=bool,
+            default=False,
+            non_db=True,
+            help="Run all the fields (and max_hdims) of a muon site in a single UNDI pythonjob, instead of one job per point.",
+        )
+        spec.input(
+            "undi_flat",
+            valid_type=bool,
+            default=False,
+            non_db=True,
+            help="Run the polarization in a single workgraph without sub-graphs: one UNDI pythonjob (one ArrayData) "
+            "per site and one Kubo-Toyabe task for all the sites.",
+        )
+        spec.input(
+            "undi_max_number_jobs",
+            valid_type=int,
+            required=False,
+            non_db=True,
+            help="Maximum number of polarization jobs (or site sub-graphs) running at the same time.",
+        )
+        spec.input(
+            "undi_hdim_tolerance",
+            valid_type=orm.Float,
+            required=False,
+            help="If provided, the convergence check is run for each site, and stops at the first max_hdim for which "
+            "max|ΔP(t)| with respect to the next one is below this tolerance. This max_hdim is then used for the production runs.",
+        )
+        spec.input(
+            "undi_cache_dir",
+            valid_type=orm.Str,
+            required=False,
+            help="Directory, on the computer of the undi_code, where the UNDI results are cached. Runs with the same "
+            "muon-centred cluster (atoms and positions, rounded to 0.01 Angstrom) and the same settings are then reused "
+            "across sites and workchains, instead of being recomputed.",
+        )
+        spec.input(
+            "undi_symmetry_tolerance",
+            valid_type=orm.Float,
+            required=False,
+            help="If provided, muon sites whose muon-centred environments are equivalent under a symmetry of the "
+            "input structure, within this tolerance (Angstrom), are computed only once. The results of the "
+            "representative site are then shown for all the equivalent ones: this is exact for the powder average, "
+            "while the x, y, z signals refer to the orientation of the representative site.",
+        )
+        
         spec.expose_inputs(
             FindMuonWorkChain,
             namespace="findmuon",
@@ -185,6 +234,12 @@ class ImplantMuonWorkChain(WorkChain):
         undi_metadata=None,
         undi_fields=None,
         undi_max_hdims=None,
+        undi_batched: bool = False,
+        undi_flat: bool = False,
+        undi_max_number_jobs=None,
+        undi_hdim_tolerance=None,
+        undi_cache_dir=None,
+        undi_symmetry_tolerance=None,
         protocol=None,
         enforce_defaults: bool = True,
         compute_findmuon: bool = True,
@@ -295,6 +350,17 @@ class ImplantMuonWorkChain(WorkChain):
         
         if undi_max_hdims and compute_polarization_undi:
             builder.undi_max_hdims = orm.List(undi_max_hdims)
+        
+        builder.undi_batched = undi_batched
+        builder.undi_flat = undi_flat
+        if undi_max_number_jobs:
+            builder.undi_max_number_jobs = undi_max_number_jobs
+        if undi_hdim_tolerance and compute_polarization_undi:
+            builder.undi_hdim_tolerance = orm.Float(undi_hdim_tolerance)
+        if undi_cache_dir and compute_polarization_undi:
+            builder.undi_cache_dir = orm.Str(undi_cache_dir)
+        if undi_symmetry_tolerance and compute_polarization_undi:
+            builder.undi_symmetry_tolerance = orm.Float(undi_symmetry_tolerance)
             
         builder.kind_names = orm.List(
             list(
@@ -386,6 +452,20 @@ class ImplantMuonWorkChain(WorkChain):
     def prepare_polarization(self):
         if self.ctx.implant_muon:
             self.ctx.structure_group = self.get_structures_group_from_findmuon(self.ctx.findmuon)
+            if "undi_symmetry_tolerance" in self.inputs:
+                self.ctx.equivalent_sites = group_equivalent_sites(
+                    {idx: structure.get_ase() for idx, structure in self.ctx.structure_group.items()},
+                    self.ctx.structure.get_ase(),
+                    tolerance=self.inputs.undi_symmetry_tolerance.value,
+                )
+                self.ctx.structure_group = {
+                    idx: structure for idx, structure in self.ctx.structure_group.items()
+                    if self.ctx.equivalent_sites[idx] == idx
+                }
+                self.report(
+                    f"{len(self.ctx.equivalent_sites) - len(self.ctx.structure_group)} muon sites are symmetry equivalent "
+                    f"to other ones, computing the polarization only for the sites {list(self.ctx.structure_group.keys())}."
+                )
         else:  # we want only polarization, so use the input structure.
             if isinstance(self.ctx.structure, HubbardStructureData):
                     structure_ase = self.ctx.structure.get_ase()
@@ -404,6 +484,11 @@ class ImplantMuonWorkChain(WorkChain):
             max_hdims = self.inputs.get("undi_max_hdims", [10**2, 10**4, 10**6, 10**8]),
             B_mods = self.inputs.get("undi_fields", [0, 2e-3, 4e-3, 6e-3, 8e-3]),
             metadata = metadata,
+            batched = self.inputs.undi_batched,
+            hdim_tolerance = self.inputs.undi_hdim_tolerance.value if "undi_hdim_tolerance" in self.inputs else None,
+            cache_dir = self.inputs.undi_cache_dir.value if "undi_cache_dir" in self.inputs else None,
+            flat = self.inputs.undi_flat,
+            max_number_jobs = self.inputs.get("undi_max_number_jobs", None),
             )
         inputs = {
             "workgraph_data": workgraph.to_dict(),
@@ -411,6 +496,9 @@ class ImplantMuonWorkChain(WorkChain):
             
         }
         process = self.submit(WorkGraphEngine, **inputs)
+        if "equivalent_sites" in self.ctx:
+            # used by the results model to show the representative results for all the equivalent sites.
+            process.base.extras.set("equivalent_sites", self.ctx.equivalent_sites)
         self.report(
             f"submitting `Workgraph` for polarization calculation: <PK={process.pk}>"
         )
@@ -427,11 +515,19 @@ class ImplantMuonWorkChain(WorkChain):
                 self.report(f"the child WorkGraph with <PK={polarization.pk}> failed")
                 return self.exit_codes.ERROR_POLARIZATION_FAILED
             else:
-                self.out(
-                        "polarization",
-                        #polarization.outputs.execution_count,
-                        polarization.called[0].outputs.results.KT_task,
-                    )
+                if self.inputs.undi_flat:
+                    # the single KT task of the flat workgraph, with the results of all the sites.
+                    KT_node = [
+                        node for node in polarization.called
+                        if node.base.attributes.all.get("metadata_inputs",{}).get("metadata",{}).get("call_link_label") == "KuboToyabe_run"
+                    ][0]
+                    self.out("polarization", KT_node.outputs.result)
+                else:
+                    self.out(
+                            "polarization",
+                            #polarization.outputs.execution_count,
+                            polarization.called[0].outputs.results.KT_task,
+                        )
                 self.report(f"Undi calculation was successful.")
                 
 
@@ -0,0 +1,23 @@
+import numpy as np
+
+from aiidalab_qe_muon.utils.downsample import minmax_downsample
+
+
+def test_minmax_downsample():
+    """The extrema of each bucket are kept, within the requested number of points and x range."""
+    x = np.linspace(0, 20, 10001)
+    y = np.exp(-x / 5) * np.cos(2 * np.pi * x)
+
+    indexes = minmax_downsample(x, y, 400)
+    assert len(indexes) <= 400
+    assert np.all(np.diff(indexes) > 0)
+    assert indexes[0] == 0 and indexes[-1] == len(x) - 1
+    assert np.argmin(y) in indexes and np.argmax(y) in indexes
+
+    # zooming in, the points around the range are returned at full resolution if they are few enough.
+    indexes = minmax_downsample(x, y, 400, x_range=(1.0, 1.5))
+    assert x[indexes[0]] < 1.0 and x[indexes[-1]] > 1.5
+    assert np.all(np.diff(indexes) == 1)
+
+    # short curves are not downsampled.
+    assert np.array_equal(minmax_downsample(x[:100], y[:100], 400), np.arange(100))
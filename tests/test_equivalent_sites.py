@@ -0,0 +1,31 @@
+import numpy as np
+from ase.build import bulk
+
+from aiidalab_qe_muon.utils.symmetry import group_equivalent_sites
+
+
+def _copper_supercell_with_muon(position):
+    """2x2x2 supercell of the conventional fcc Cu cell, with a muon (H) at `position` (in units of a)."""
+    atms = bulk("Cu", "fcc", a=3.6, cubic=True) * (2, 2, 2)
+    atms.append("H")
+    atms.positions[-1] = np.array(position) * 3.6
+    return atms
+
+
+def test_group_equivalent_sites_fcc():
+    """Octahedral sites are equivalent among them, but not to the tetrahedral ones."""
+    unitcell = bulk("Cu", "fcc", a=3.6, cubic=True)
+    sites = {
+        "1": _copper_supercell_with_muon([0.5, 0.5, 0.5]),  # octahedral
+        "2": _copper_supercell_with_muon([0.25, 0.25, 0.25]),  # tetrahedral
+        "3": _copper_supercell_with_muon([1.0, 0.5, 1.0]),  # octahedral, on the edge of the cell
+        "4": _copper_supercell_with_muon([0.75, 0.25, 0.75]),  # tetrahedral
+        "5": _copper_supercell_with_muon([0.55, 0.5, 0.5]),  # displaced octahedral
+    }
+
+    representatives = group_equivalent_sites(sites, unitcell, tolerance=0.05, cutoff=5.0)
+    assert representatives == {"1": "1", "2": "2", "3": "1", "4": "2", "5": "5"}
+
+    # within a larger tolerance, the displaced muon is also equivalent.
+    representatives = group_equivalent_sites(sites, unitcell, tolerance=0.3, cutoff=5.0)
+    assert representatives["5"] == "1"
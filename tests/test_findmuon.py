@@ -0,0 +1,51 @@
+import numpy as np
+
+from aiidalab_qe_muon.utils.findmuon import DISTORTION_COLUMNS, build_distortion_array
+
+
+def _distortions(n_atoms_per_site):
+    """Distortions as exported from the FindMuonWorkChain, {site: {element: {column: list}}}."""
+    rng = np.random.default_rng(0)
+    return {
+        site: {
+            element: {column: list(rng.random(n_atoms)) for column in DISTORTION_COLUMNS}
+            for element, n_atoms in per_element.items()
+        }
+        for site, per_element in n_atoms_per_site.items()
+    }
+
+
+def test_build_distortion_array():
+    """The atoms of each site and element are contiguous, and sliced back as exported."""
+    distortions = _distortions({
+        1: {"Cu": 4, "O": 2},
+        2: {"Cu": 3, "H": 0, "O": 1},
+        3: {},  # a site without any distortion.
+    })
+
+    array, site_slices, element_slices = build_distortion_array(distortions)
+    assert array.shape == (10,)
+    assert list(array.dtype.names) == ["site", "element"] + DISTORTION_COLUMNS
+    assert set(site_slices) == set(element_slices) == {"1", "2", "3"}
+
+    assert site_slices["1"] == slice(0, 6)
+    assert site_slices["2"] == slice(6, 10)
+    assert len(array[site_slices["3"]]) == 0
+    assert element_slices["3"] == {}
+    assert len(array[element_slices["2"]["H"]]) == 0
+
+    for site, per_element in distortions.items():
+        assert np.all(array[site_slices[str(site)]]["site"] == str(site))
+        for element, data in per_element.items():
+            atoms = array[element_slices[str(site)][element]]
+            assert np.all(atoms["element"] == element)
+            for column in DISTORTION_COLUMNS:
+                assert np.allclose(atoms[column], data[column])
+
+
+def test_build_distortion_array_empty():
+    """No sites gives an empty array, with the same fields."""
+    array, site_slices, element_slices = build_distortion_array({})
+    assert array.shape == (0,)
+    assert list(array.dtype.names) == ["site", "element"] + DISTORTION_COLUMNS
+    assert site_slices == element_slices == {}
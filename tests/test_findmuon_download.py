@@ -0,0 +1,70 @@
+import base64
+import os
+import time
+
+import pytest
+
+findmuonmodel = pytest.importorskip("aiidalab_qe_muon.app.results.sub_mvc.findmuonmodel")
+
+
+@pytest.fixture
+def displayed(monkeypatch):
+    """The objects displayed by the model."""
+    import IPython.display
+
+    displayed = []
+    monkeypatch.setattr(IPython.display, "display", displayed.append)
+    return displayed
+
+
+@pytest.fixture
+def model():
+    """A model whose archive is 16 KiB of known bytes."""
+    model = findmuonmodel.FindMuonModel()
+    model.content = bytes(range(256)) * 64
+    model._prepare_data_for_download = lambda: {"filename": "muon exports.zip"}
+    model.write_archive = lambda files_dict, archive: archive.write(model.content)
+    return model
+
+
+def test_download_small_archive(model, displayed, monkeypatch):
+    """Archives up to max_payload_size are downloaded as a base64 payload."""
+    monkeypatch.setattr(findmuonmodel.FindMuonModel, "_get_jupyter_server", staticmethod(pytest.fail))
+    model.download_data()
+
+    assert len(displayed) == 1
+    assert base64.b64encode(model.content).decode() in displayed[0].data
+
+
+def test_download_large_archive(model, displayed, monkeypatch, tmp_path):
+    """Larger archives are served from a temporary folder of the jupyter server root, then deleted."""
+    monkeypatch.setattr(
+        findmuonmodel.FindMuonModel, "_get_jupyter_server", staticmethod(lambda: (tmp_path, "/user/muon/")),
+    )
+    model.max_payload_size = 1024
+    model.export_lifetime = 0.5
+    stale = tmp_path / "muon_export_stale"
+    stale.mkdir()
+    os.utime(stale, (0, 0))
+
+    model.download_data()
+    assert not stale.exists()
+    (folder,) = tmp_path.glob("muon_export_*")
+    assert (folder / "muon exports.zip").read_bytes() == model.content
+    assert len(displayed) == 1
+    assert f"'/user/muon/files/{folder.name}/muon%20exports.zip?download=1'" in displayed[0].data
+
+    deadline = time.time() + 10
+    while folder.exists() and time.time() < deadline:
+        time.sleep(0.1)
+    assert not folder.exists()
+
+
+def test_download_large_archive_without_server(model, displayed, monkeypatch):
+    """Without a jupyter server to serve them, larger archives are also downloaded as a payload."""
+    monkeypatch.setattr(findmuonmodel.FindMuonModel, "_get_jupyter_server", staticmethod(lambda: None))
+    model.max_payload_size = 1024
+    model.download_data()
+
+    assert len(displayed) == 1
+    assert base64.b64encode(model.content).decode() in displayed[0].data
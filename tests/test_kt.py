@@ -0,0 +1,176 @@
+import numpy as np
+import pytest
+from ase.build import bulk
+from ase.neighborlist import neighbor_list
+
+from aiidalab_qe_muon.utils.KT import (
+    ISOTOPE_TABLE,
+    batched_kubo_toyabe,
+    compute_second_moments,
+    factor,
+    gamma_mu,
+    get_isotopes,
+    kubo_toyabe,
+    kubo_toyabe_result,
+    munhbar,
+    second_moment,
+)
+
+
+def test_isotope_table():
+    """The per-Z slices and second moment prefactors are consistent."""
+    # Cu: 63Cu and 65Cu, both with spin 3/2.
+    isotopes = get_isotopes(29)
+    assert isotopes.shape == (2, 3)
+    assert np.allclose(isotopes[:, 1], 1.5)
+    assert np.isclose(isotopes[:, 0].sum(), 100)
+
+    prefactor = np.sum(
+        isotopes[:, 0] / 100 * isotopes[:, 1] * (isotopes[:, 1] + 1) * (munhbar * isotopes[:, 2]) ** 2
+    )
+    assert np.isclose(ISOTOPE_TABLE.second_moment_prefactor[29], prefactor)
+
+    with pytest.raises(ValueError):
+        ISOTOPE_TABLE.spin[0] = 1.0
+
+
+def test_batched_kubo_toyabe_zero_field():
+    """The batched zero field KT is the single-site KT, stacked."""
+    t = np.linspace(0, 20e-6, 1000)
+    second_moments = np.array([0.3e6, 0.1e6, 0.05e6]) ** 2
+
+    KT = batched_kubo_toyabe(t, second_moments)
+
+    assert KT.shape == (3, 1000)
+    for i, sm in enumerate(second_moments):
+        assert np.allclose(KT[i], kubo_toyabe(t, sm))
+
+
+@pytest.mark.parametrize("B_lf", [1e-4, 2e-3, 1e-1])
+def test_batched_kubo_toyabe_longitudinal_field(B_lf):
+    """Compare the closed form LF KT with a brute force integration."""
+    t = np.linspace(0, 20e-6, 2001)
+    second_moments = np.array([0.3e6, 0.1e6]) ** 2
+
+    KT = batched_kubo_toyabe(t, second_moments, B_lf=[0.0, B_lf])
+
+    assert KT.shape == (2, 2, 2001)
+    # zero field is recovered.
+    assert np.allclose(KT[:, 0], batched_kubo_toyabe(t, second_moments))
+
+    w = gamma_mu * B_lf
+    for i, d2 in enumerate(second_moments):
+        tau = np.linspace(0, t[-1], 400001)
+        integrand = np.exp(-0.5 * d2 * tau**2) * np.sin(w * tau)
+        integral = np.concatenate(
+            [[0], np.cumsum(0.5 * (integrand[1:] + integrand[:-1]) * np.diff(tau))]
+        )
+        integral = np.interp(t, tau, integral)
+        reference = (
+            1
+            - 2 * d2 / w**2 * (1 - np.exp(-0.5 * d2 * t**2) * np.cos(w * t))
+            + 2 * d2**2 / w**3 * integral
+        )
+        assert np.allclose(KT[i, 1], reference, atol=1e-4)
+
+
+def test_compute_second_moments_matches_neighbor_list():
+    """The muon-centred lattice sums reproduce the pair neighbour list sums."""
+    atms = bulk("NaCl", "rocksalt", a=5.6, cubic=True)
+    atms.append("H")
+    atms.positions[-1] = [1.4, 1.4, 1.4]
+    atms.append("H")
+    atms.positions[-1] = [4.1, 1.4, 1.3]
+    atms.rattle(0.05, seed=42)
+
+    second_moments = compute_second_moments(atms, cutoff_distances={11: 12, 17: 15})
+
+    for e, cutoff in [(11, 12), (17, 15)]:
+        lattice_sum = 0.5 * np.sum(neighbor_list("d", atms, cutoff={(1, e): cutoff}) ** -6)
+        reference = ISOTOPE_TABLE.second_moment_prefactor[e] * lattice_sum * factor / 2
+        assert np.isclose(second_moments[e], reference)
+
+    converged = compute_second_moments(atms, tolerance=1e-3)
+    assert converged.keys() == second_moments.keys()
+    for e in converged:
+        assert np.isclose(converged[e], compute_second_moments(atms)[e], rtol=1e-3)
+
+
+def test_compute_second_moments_tail_correction():
+    """The tail corrected sums at 10 Å are within the estimated error from the converged ones."""
+    atms = bulk("NaCl", "rocksalt", a=5.6, cubic=True) * (2, 2, 2)
+    atms.append("H")
+    atms.positions[-1] = [1.4, 1.4, 1.4]
+
+    reference = compute_second_moments(atms, cutoff_distances={11: 60, 17: 60})
+    corrected, errors = compute_second_moments(atms, tail_correction=True, return_errors=True)
+    truncated = compute_second_moments(atms, cutoff_distances={11: 10, 17: 10})
+
+    for e in reference:
+        assert abs(corrected[e] - reference[e]) <= errors[e]
+        assert abs(corrected[e] - reference[e]) < abs(truncated[e] - reference[e])
+
+
+def test_compute_second_moments_no_host_species():
+    """A structure with only the muon has no species contributions."""
+    atms = bulk("Cu", "fcc", a=3.6, cubic=True)
+    atms = atms[:0]
+    atms.append("H")
+
+    assert compute_second_moments(atms) == {}
+    assert compute_second_moments(atms, tolerance=1e-3) == {}
+    assert compute_second_moments(atms, tail_correction=True, return_errors=True) == ({}, {})
+
+
+def test_kubo_toyabe_result_pickled_by_value(tmp_path):
+    """The KT pythonjob function, pickled by value, runs in a new process."""
+    import pickle
+    import subprocess
+    import sys
+
+    import cloudpickle
+
+    from aiidalab_qe_muon.utils import KT
+
+    atms = bulk("Cu", "fcc", a=3.6, cubic=True) * (2, 2, 2)
+    atms.append("H")
+    atms.positions[-1] = [1.8, 1.8, 1.8]
+
+    cloudpickle.register_pickle_by_value(KT)
+    try:
+        (tmp_path / "function.pkl").write_bytes(cloudpickle.dumps(kubo_toyabe_result))
+    finally:
+        cloudpickle.unregister_pickle_by_value(KT)
+    (tmp_path / "atoms.pkl").write_bytes(pickle.dumps(atms))
+
+    script = (
+        "import pickle, sys; "
+        "function = pickle.load(open(sys.argv[1], 'rb')); "
+        "pickle.dump(function(pickle.load(open(sys.argv[2], 'rb'))), open(sys.argv[3], 'wb'))"
+    )
+    subprocess.run(
+        [sys.executable, "-c", script, *(str(tmp_path / name) for name in ["function.pkl", "atoms.pkl", "result.pkl"])],
+        check=True,
+    )
+    result = pickle.loads((tmp_path / "result.pkl").read_bytes())["result"]
+    assert np.allclose(result["KT"], kubo_toyabe_result(atms)["result"]["KT"])
+    assert len(result["t"]) == len(result["KT"])
+
+
+def test_second_moment_tail_correction_and_error():
+    """The KT tasks use the tail corrected second moment, and store its error estimate."""
+    atms = bulk("Cu", "fcc", a=3.6, cubic=True) * (2, 2, 2)
+    atms.append("H")
+    atms.positions[-1] = [1.8, 1.8, 1.8]
+
+    contribs, errors = compute_second_moments(atms, tail_correction=True, return_errors=True)
+    S2, error = second_moment(atms)
+    assert np.isclose(S2, sum(contribs.values()))
+    assert np.isclose(error, sum(errors.values()))
+    # the tail corrected 10 Å sum agrees with the 40 Å one.
+    assert np.isclose(S2, sum(compute_second_moments(atms).values()), rtol=1e-3)
+    assert 0 < error < 1e-3 * S2
+
+    result = kubo_toyabe_result(atms)["result"]
+    assert result["second_moment"] == S2
+    assert result["second_moment_error"] == error
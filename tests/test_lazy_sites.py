@@ -0,0 +1,34 @@
+from aiidalab_qe_muon.undi_interface.polarization import LazySites
+
+
+def test_lazy_sites_maxsize():
+    """Sites are loaded once while kept, aliases share their representative, and resizing evicts."""
+    loads = []
+
+    def load(muon_index):
+        loads.append(muon_index)
+        return {"muon_index": muon_index}
+
+    muons = LazySites(["1", "2", "3"], load, aliases={"4": "1"}, maxsize=2)
+    assert sorted(muons) == ["1", "2", "3", "4"]
+    assert loads == []
+
+    assert muons["4"] is muons["1"]
+    muons["2"]
+    muons["1"]
+    assert loads == ["1", "2"]
+
+    # the least recently used site ("2") is dropped, then loaded again.
+    muons["3"]
+    muons["2"]
+    assert loads == ["1", "2", "3", "2"]
+
+    muons.maxsize = 3
+    muons["1"]
+    muons["3"]
+    muons["2"]
+    assert loads == ["1", "2", "3", "2", "1"]
+    assert len(muons.loaded_values()) == 3
+
+    muons.maxsize = 1
+    assert muons.loaded_values() == [{"muon_index": "2"}]
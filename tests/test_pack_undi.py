@@ -0,0 +1,70 @@
+import numpy as np
+
+from aiidalab_qe_muon.undi_interface.calculations.pythonjobs import (
+    UNDI_DIRECTIONS,
+    UNDI_GEOMETRIES,
+    _pack_undi_entries,
+)
+
+
+def _entry(B_mod, probabilities, t):
+    """Undi results of a (B_mod, max_hdim) point, one per isotope combination, with distinct signals."""
+    results = []
+    for c, probability in enumerate(probabilities):
+        res = {
+            "t": t,
+            "cluster_isotopes": [f"{63 + 2 * c}Cu"],
+            "spins": [1.5],
+            "probability": probability,
+        }
+        for d, direction in enumerate(UNDI_DIRECTIONS):
+            for g, geometry in enumerate(UNDI_GEOMETRIES):
+                res[f"signal_{direction}_{geometry}"] = np.full(len(t), 10 * c + 2 * d + g + B_mod)
+        results.append(res)
+    return {"B_mod": B_mod, "max_hdim": 1e4, "results": results}
+
+
+def test_pack_undi_entries_shape():
+    """The points are stacked, padding with zeros the ones with fewer isotope combinations."""
+    t = np.linspace(0, 20e-6, 5)
+    entries = [_entry(0.0, [0.7, 0.3], t), _entry(2e-3, [1.0], t)]
+
+    outputs = _pack_undi_entries(entries)
+    polarization = outputs["polarization"]
+    assert polarization.shape == (2, 2, len(UNDI_DIRECTIONS), len(UNDI_GEOMETRIES), len(t))
+    assert polarization.dtype == np.float32
+
+    z, tf = UNDI_DIRECTIONS.index("z"), UNDI_GEOMETRIES.index("tf")
+    assert np.allclose(polarization[0, 1, z, tf], entries[0]["results"][1]["signal_z_tf"])
+    assert np.allclose(polarization[1, 1], 0)
+
+    metadata = outputs["metadata"]
+    assert metadata["B_mods"] == [0.0, 2e-3]
+    assert metadata["max_hdims"] == [1e4, 1e4]
+    assert np.allclose(metadata["t"], t)
+    assert [len(point) for point in metadata["combinations"]] == [2, 1]
+    assert metadata["combinations"][0][1] == {"cluster_isotopes": ["65Cu"], "spins": [1.5], "probability": 0.3}
+
+
+def test_pack_undi_entries_weighted_average():
+    """The averaged polarization is the probability weighted average over the actual combinations."""
+    t = np.linspace(0, 20e-6, 5)
+    entries = [_entry(0.0, [0.7, 0.3], t), _entry(2e-3, [0.25, 0.25], t)]
+
+    outputs = _pack_undi_entries(entries)
+    averaged = outputs["averaged_polarization"]
+    assert averaged.shape == (2, len(UNDI_DIRECTIONS), len(UNDI_GEOMETRIES), len(t))
+
+    for p, entry in enumerate(entries):
+        for d, direction in enumerate(UNDI_DIRECTIONS):
+            for g, geometry in enumerate(UNDI_GEOMETRIES):
+                expected = np.average(
+                    [res[f"signal_{direction}_{geometry}"] for res in entry["results"]],
+                    weights=[res["probability"] for res in entry["results"]],
+                    axis=0,
+                )
+                assert np.allclose(averaged[p, d, g], expected)
+
+    # the padding of a point with fewer combinations does not enter its average.
+    single = _pack_undi_entries([entries[0], _entry(2e-3, [1.0], t)])["averaged_polarization"]
+    assert np.allclose(single[1], _pack_undi_entries([_entry(2e-3, [1.0], t)])["averaged_polarization"][0])
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from ase.build import bulk
+
+from aiidalab_qe_muon.undi_interface.calculations import pythonjobs
+from aiidalab_qe_muon.undi_interface.calculations.pythonjobs import _undi_cache_key
+
+
+@pytest.fixture(autouse=True)
+def undi_version(monkeypatch):
+    """The key does not need undi itself, only its version."""
+    monkeypatch.setattr(pythonjobs, "_undi_version", lambda: "1.0+test")
+
+
+def _copper_with_muon(repeat=(1, 1, 1), shift=np.zeros(3)):
+    atms = bulk("Cu", "fcc", a=3.6, cubic=True) * repeat
+    atms.append("H")
+    atms.positions[-1] = [1.8, 1.8, 1.8]
+    atms.positions += shift
+    return atms
+
+
+def test_undi_cache_key_muon_cluster():
+    """The key depends on the muon-centred cluster and on the settings, not on the cell."""
+    settings = dict(B_mod=0.0, max_hdim=1e6, algorithm="fast", angular_integration_steps=7)
+    reference = _undi_cache_key(_copper_with_muon(), **settings)
+
+    # same cluster: translated structure, and max_hdim given as int.
+    assert _undi_cache_key(_copper_with_muon(shift=np.array([0.3, -0.2, 0.1])), **settings) == reference
+    assert _undi_cache_key(_copper_with_muon(), **dict(settings, max_hdim=1000000)) == reference
+    # with a cutoff, supercells where the periodic images of the muon are beyond it.
+    assert _undi_cache_key(_copper_with_muon(repeat=(3, 3, 3)), cutoff=8.0, **settings) == _undi_cache_key(
+        _copper_with_muon(repeat=(4, 3, 5)), cutoff=8.0, **settings
+    )
+
+    # different field, a different supercell (without cutoff), a periodic image of the muon within
+    # the cutoff, or a displaced neighbour.
+    assert _undi_cache_key(_copper_with_muon(), **dict(settings, B_mod=2e-3)) != reference
+    assert _undi_cache_key(_copper_with_muon(repeat=(3, 3, 3)), **settings) != _undi_cache_key(
+        _copper_with_muon(repeat=(4, 3, 5)), **settings
+    )
+    assert _undi_cache_key(_copper_with_muon(repeat=(3, 3, 3)), cutoff=8.0, **settings) != _undi_cache_key(
+        _copper_with_muon(), cutoff=8.0, **settings
+    )
+    distorted = _copper_with_muon()
+    distorted.positions[0] += [0.0, 0.0, 0.05]
+    assert _undi_cache_key(distorted, **settings) != reference
+
+
+def test_undi_cache_key_beyond_cutoff(monkeypatch):
+    """Structures which differ only beyond the cutoff share the key only if the cutoff is given."""
+    settings = dict(B_mod=0.0, max_hdim=1e6, algorithm="fast", angular_integration_steps=7)
+    pristine = _copper_with_muon(repeat=(4, 4, 4))
+    substituted = pristine.copy()
+    far = np.argmax(np.linalg.norm(pristine.positions - pristine.positions[-1], axis=1))
+    assert np.linalg.norm(pristine.positions[far] - pristine.positions[-1]) > 8.0
+    substituted.numbers[far] = 47  # Ag
+
+    # undi can use the whole structure: by default, all of it is in the key.
+    assert _undi_cache_key(pristine, **settings) != _undi_cache_key(substituted, **settings)
+    # within the cutoff they are the same cluster, and the cutoff is part of the key.
+    assert _undi_cache_key(pristine, cutoff=6.0, **settings) == _undi_cache_key(substituted, cutoff=6.0, **settings)
+    assert _undi_cache_key(pristine, cutoff=6.0, **settings) != _undi_cache_key(pristine, cutoff=6.5, **settings)
+
+    # and a new undi gives new keys.
+    reference = _undi_cache_key(pristine, **settings)
+    monkeypatch.setattr(pythonjobs, "_undi_version", lambda: "1.1+test")
+    assert _undi_cache_key(pristine, **settings) != reference